@@ -0,0 +1,163 @@
+# amei_client.py
+# Cliente HTTP único para todas as chamadas à API AMEI.
+# Mantém uma requests.Session com pool de conexões (keep-alive) por processo,
+# timeouts de conexão/leitura, retentativas com backoff exponencial + jitter
+# e um circuit breaker simples para não prender os workers do gunicorn
+# quando a API estiver lenta ou fora do ar.
+
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Configuração (ajustável via variáveis de ambiente) ---
+POOL_SIZE = int(os.environ.get("AMEI_POOL_SIZE", "20"))
+CONNECT_TIMEOUT = float(os.environ.get("AMEI_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("AMEI_READ_TIMEOUT", "30"))
+MAX_RETRIES = int(os.environ.get("AMEI_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.environ.get("AMEI_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.environ.get("AMEI_BACKOFF_MAX", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("AMEI_CIRCUIT_FAILURE_THRESHOLD", "10"))
+CIRCUIT_COOLDOWN = float(os.environ.get("AMEI_CIRCUIT_COOLDOWN", "30"))
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Levantada quando o circuit breaker está aberto e a chamada nem é tentada."""
+
+
+# --- Estado do módulo (um por processo/worker) ---
+_session: requests.Session | None = None
+_session_pid: int | None = None
+_session_lock = threading.Lock()
+
+_circuit_lock = threading.Lock()
+_consecutive_failures = 0
+_circuit_open_until = 0.0
+
+# 'handler(token_recusado) -> novo_token | None', registrado pelo login_auth
+_unauthorized_handler = None
+
+
+def set_unauthorized_handler(handler):
+    """Registra quem renova o token quando a API responde 401 (ver login_auth.renew_rejected_token)."""
+    global _unauthorized_handler
+    _unauthorized_handler = handler
+
+
+def get_session() -> requests.Session:
+    """
+    Retorna a Session compartilhada do processo atual.
+    Se o processo mudou (fork do gunicorn), cria uma nova para não
+    compartilhar sockets entre workers.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                _session_pid = pid
+    return _session
+
+
+def _check_circuit():
+    if _circuit_open_until and time.monotonic() < _circuit_open_until:
+        raise CircuitOpenError(
+            f"Circuit breaker aberto: API AMEI indisponível, nova tentativa em "
+            f"{_circuit_open_until - time.monotonic():.0f}s."
+        )
+
+
+def _record_success():
+    global _consecutive_failures, _circuit_open_until
+    with _circuit_lock:
+        _consecutive_failures = 0
+        _circuit_open_until = 0.0
+
+
+def _record_failure():
+    global _consecutive_failures, _circuit_open_until
+    with _circuit_lock:
+        _consecutive_failures += 1
+        if _consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            _circuit_open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            print(f"AVISO [AMEI CLIENT]: {_consecutive_failures} falhas seguidas. Circuit breaker aberto por {CIRCUIT_COOLDOWN:.0f}s.")
+
+
+def _backoff_delay(attempt: int, response: requests.Response | None = None) -> float:
+    """Backoff exponencial com 'full jitter', respeitando o Retry-After quando enviado."""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Faz uma requisição à API AMEI usando a sessão compartilhada.
+    Repete em erros de conexão/timeout e em respostas 429/5xx.
+    Em 401, renova o token da clínica e repete UMA vez; o dict 'headers' recebido é
+    atualizado no lugar, então as próximas chamadas de quem o reutiliza já vão com o token novo.
+    Os erros continuam sendo 'requests.exceptions.RequestException',
+    então o tratamento existente nos chamadores permanece válido.
+    """
+    response = _request_with_retries(method, url, **kwargs)
+    headers = kwargs.get('headers')
+    if response.status_code != 401 or _unauthorized_handler is None or not headers:
+        return response
+
+    authorization = headers.get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return response
+    new_token = _unauthorized_handler(authorization[len('Bearer '):])
+    if not new_token:
+        return response
+    headers['Authorization'] = f"Bearer {new_token}"
+    return _request_with_retries(method, url, **kwargs)
+
+
+def _request_with_retries(method: str, url: str, **kwargs) -> requests.Response:
+    _check_circuit()
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    session = get_session()
+
+    attempt = 0
+    while True:
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES:
+                _record_success()
+                return response
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= MAX_RETRIES:
+                _record_failure()
+                raise
+            print(f"AVISO [AMEI CLIENT]: {method} {url} falhou ({e.__class__.__name__}). Tentativa {attempt + 1}/{MAX_RETRIES}.")
+        else:
+            if attempt >= MAX_RETRIES:
+                _record_failure()
+                # Devolve a última resposta; o raise_for_status() do chamador trata o erro
+                return response
+            print(f"AVISO [AMEI CLIENT]: {method} {url} retornou {response.status_code}. Tentativa {attempt + 1}/{MAX_RETRIES}.")
+
+        time.sleep(_backoff_delay(attempt, response))
+        attempt += 1
+        _check_circuit()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
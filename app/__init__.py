@@ -1,4 +1,5 @@
 from flask import Flask
+from flask_compress import Compress
 import os
 import json
 from dotenv import load_dotenv
@@ -27,6 +28,13 @@ def create_app():
         cookie_value = ""
 
     app.config['COOKIE_VALUE'] = os.environ.get("COOKIE_VALUE", cookie_value)
+
+    # --- Compressão (gzip/brotli) das respostas ---
+    # Respostas em stream (SSE de /api/cache_events, exportações CSV/XLSX) ficam de fora:
+    # o compressor seguraria os pedaços e o navegador não receberia nada até o fim.
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    app.config['COMPRESS_STREAMS'] = False
+    Compress(app)
     
     # --- Registrar Blueprints ---
     # (Nenhuma alteração aqui)
@@ -36,6 +44,7 @@ def create_app():
     from .routes.cache_routes import cache_bp
     from app.routes.user_routes import user_bp
     from app.routes.superadmin_routes import superadmin_bp
+    from app.routes.analytics_routes import analytics_bp
 
     app.register_blueprint(auth_bp)
     app.register_blueprint(main_bp)
@@ -43,6 +52,7 @@ def create_app():
     app.register_blueprint(cache_bp)
     app.register_blueprint(user_bp)
     app.register_blueprint(superadmin_bp)
+    app.register_blueprint(analytics_bp)
 
     # --- Hooks da Aplicação ---
     
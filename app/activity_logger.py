@@ -1,7 +1,11 @@
 # app/activity_logger.py
 import os
-from datetime import datetime
-from flask import request, session
+import atexit
+import queue
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from flask import request, session, has_request_context
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
@@ -13,31 +17,219 @@ url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 supabase: Client = create_client(url, key)
 
+# --- Gravação em background ---
+# Os registros entram numa fila em memória e uma thread os grava em lote,
+# para que o log não adicione uma ida ao Supabase em cada requisição.
+LOG_QUEUE_MAX_SIZE = int(os.environ.get("ACTIVITY_LOG_QUEUE_SIZE", "5000"))
+LOG_BATCH_SIZE = int(os.environ.get("ACTIVITY_LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_LOG_FLUSH_INTERVAL", "2.0"))  # segundos
+# Tempo máximo que o encerramento do processo espera o lote que a thread já está gravando
+LOG_SHUTDOWN_TIMEOUT = float(os.environ.get("ACTIVITY_LOG_SHUTDOWN_TIMEOUT", "10.0"))  # segundos
+
+_log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_MAX_SIZE)
+_log_stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+_stats_lock = threading.Lock()
+_writer_thread: threading.Thread | None = None
+_writer_pid: int | None = None
+_writer_lock = threading.Lock()
+# Registros que a thread já tirou da fila e ainda não terminou de gravar
+_in_flight = 0
+_in_flight_cond = threading.Condition()
+_stopping = threading.Event()
+
+
+def _write_batch(batch: list):
+    try:
+        supabase.table('activity_log').insert(batch).execute()
+        with _stats_lock:
+            _log_stats["written"] += len(batch)
+            _log_stats["batches"] += 1
+    except Exception as e:
+        # Se ocorrer um erro, imprime no console para não quebrar a aplicação principal
+        with _stats_lock:
+            _log_stats["failed"] += len(batch)
+        print(f"ERRO AO REGISTRAR LOG NO SUPABASE ({len(batch)} registros): {e}")
+
+
+def _drain(max_items: int) -> list:
+    batch = []
+    while len(batch) < max_items:
+        try:
+            batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _take(item):
+    global _in_flight
+    with _in_flight_cond:
+        _in_flight += 1
+    return item
+
+
+def _batch_written(size: int):
+    global _in_flight
+    with _in_flight_cond:
+        _in_flight -= size
+        _in_flight_cond.notify_all()
+
+
+def _writer_loop():
+    """Grava quando o lote enche ou quando LOG_FLUSH_INTERVAL passa, o que vier primeiro."""
+    while True:
+        try:
+            first = _take(_log_queue.get(timeout=LOG_FLUSH_INTERVAL))
+        except queue.Empty:
+            continue
+        batch = [first]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+        # No encerramento, grava o que já pegou sem esperar o lote encher
+        while len(batch) < LOG_BATCH_SIZE and not _stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_take(_log_queue.get(timeout=min(remaining, 0.2))))
+            except queue.Empty:
+                continue
+        try:
+            _write_batch(batch)
+        finally:
+            _batch_written(len(batch))
+
+
+def _ensure_writer():
+    """Inicia a thread de gravação (uma por processo; recriada após o fork do gunicorn)."""
+    global _writer_thread, _writer_pid
+    pid = os.getpid()
+    if _writer_thread is not None and _writer_pid == pid and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        if _writer_thread is None or _writer_pid != pid or not _writer_thread.is_alive():
+            _writer_thread = threading.Thread(target=_writer_loop, name="activity-log-writer", daemon=True)
+            _writer_thread.start()
+            _writer_pid = pid
+
+
+def flush_activity_log():
+    """
+    Grava imediatamente tudo o que está na fila e espera a thread terminar o lote que ela
+    já tirou da fila (usado no encerramento do processo).
+    """
+    _stopping.set()
+    while True:
+        batch = _drain(LOG_BATCH_SIZE)
+        if not batch:
+            break
+        _write_batch(batch)
+    with _in_flight_cond:
+        if not _in_flight_cond.wait_for(lambda: _in_flight == 0, LOG_SHUTDOWN_TIMEOUT):
+            print(f"AVISO: {_in_flight} registros de log ainda sendo gravados no encerramento.")
+
+
+atexit.register(flush_activity_log)
+
+
+def get_activity_log_stats() -> dict:
+    """Contadores da fila de log: enfileirados, gravados, descartados (fila cheia), com falha e lotes."""
+    with _stats_lock:
+        return {**_log_stats, "pending": _log_queue.qsize()}
+
 
 def log_activity(action: str, details: str = ""):
     """
-    Registra uma ação na tabela 'activity_log' do Supabase.
+    Registra uma ação na tabela 'activity_log' do Supabase (em background, em lote).
     Ex: log_activity("LOGIN_SUCCESS", "Usuário 'lucas' logou com sucesso.")
     """
     try:
-        # Coleta os dados do contexto da requisição
-        username = session.get('username', 'Anônimo')
-        ip_address = request.remote_addr if request else 'N/A'
-        
-        # Monta o dicionário com os dados do log
-        # NÃO precisamos mais enviar o 'timestamp'. 
-        # O banco de dados (DEFAULT now()) cuida disso.
+        # Coleta os dados do contexto da requisição AGORA, pois a gravação acontece depois
+        in_request = has_request_context()
+        username = session.get('username', 'Anônimo') if in_request else 'Sistema'
+        ip_address = request.remote_addr if in_request else 'N/A'
+
+        # O 'timestamp' é o momento da ação (a gravação em lote pode acontecer segundos depois).
+        # O Supabase/PostgreSQL continua gerando o 'id' sozinho.
         log_data = {
             'username': username,
             'ip_address': ip_address,
             'action': action,
-            'details': details
+            'details': details,
+            'timestamp': datetime.now(timezone.utc).isoformat()
         }
-        
-        # Insere um novo registro na tabela 'activity_log'.
-        # O Supabase/PostgreSQL gera o 'id' e o 'timestamp' sozinhos.
-        supabase.table('activity_log').insert(log_data).execute()
 
+        _ensure_writer()
+        _log_queue.put_nowait(log_data)
+        with _stats_lock:
+            _log_stats["enqueued"] += 1
+
+    except queue.Full:
+        with _stats_lock:
+            _log_stats["dropped"] += 1
+        print(f"AVISO: Fila de log cheia ({LOG_QUEUE_MAX_SIZE}). Registro '{action}' descartado.")
     except Exception as e:
         # Se ocorrer um erro, imprime no console para não quebrar a aplicação principal
-        print(f"ERRO AO REGISTRAR LOG NO SUPABASE: {e}")
\ No newline at end of file
+        print(f"ERRO AO REGISTRAR LOG NO SUPABASE: {e}")
+
+
+# --- Consulta do log (visualizador do superadmin) ---
+
+def _apply_log_filters(query, filters: dict):
+    """Aplica os filtros do visualizador a uma consulta na tabela 'activity_log'."""
+    if filters.get('username'):
+        query = query.eq('username', filters['username'])
+    if filters.get('action'):
+        query = query.eq('action', filters['action'])
+    if filters.get('start_date'):
+        query = query.gte('timestamp', filters['start_date'])
+    if filters.get('end_date'):
+        end_dt = date.fromisoformat(filters['end_date']) + timedelta(days=1)
+        query = query.lt('timestamp', end_dt.isoformat())
+    if filters.get('details'):
+        # Busca por trecho (usa o índice trigram em 'details')
+        query = query.ilike('details', f"%{filters['details']}%")
+    return query
+
+
+def encode_log_cursor(row: dict) -> str:
+    return f"{row['timestamp']}|{row['id']}"
+
+
+def query_activity_log(filters: dict, cursor: str | None = None, limit: int = 100) -> tuple[list, str | None]:
+    """
+    Busca uma página do log, do mais recente para o mais antigo, usando paginação por
+    cursor (timestamp, id) em vez de OFFSET. Retorna (registros, cursor_da_próxima_página).
+    """
+    query = supabase.table('activity_log').select('id, timestamp, username, ip_address, action, details')
+    query = _apply_log_filters(query, filters)
+
+    if cursor:
+        cursor_ts, cursor_id = cursor.rsplit('|', 1)
+        query = query.or_(f'timestamp.lt."{cursor_ts}",and(timestamp.eq."{cursor_ts}",id.lt.{int(cursor_id)})')
+
+    response = query.order('timestamp', desc=True).order('id', desc=True).limit(limit + 1).execute()
+    rows = response.data or []
+
+    next_cursor = encode_log_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def get_activity_log_filter_options() -> tuple[list, list]:
+    """Usuários e ações distintos para os menus de filtro (tabela mantida por trigger)."""
+    response = supabase.table('activity_log_filter_values').select('kind, value').order('value').execute()
+    usernames = [row['value'] for row in response.data or [] if row['kind'] == 'username']
+    actions = [row['value'] for row in response.data or [] if row['kind'] == 'action']
+    return usernames, actions
+
+
+def iter_activity_log(filters: dict, page_size: int = 1000):
+    """
+    Percorre TODOS os registros que atendem aos filtros, página a página (cursor),
+    sem carregar o resultado inteiro na memória. Usado pela exportação.
+    """
+    cursor = None
+    while True:
+        rows, cursor = query_activity_log(filters, cursor=cursor, limit=page_size)
+        yield from rows
+        if not cursor:
+            break
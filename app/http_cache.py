@@ -0,0 +1,44 @@
+# app/http_cache.py
+# GET condicional (ETag / 304 Not Modified) para páginas e APIs que mudam pouco.
+# O ETag é calculado ANTES do trabalho caro (carregar o cache, renderizar, serializar):
+# se o navegador já tem essa versão, respondemos 304 sem corpo.
+
+import hashlib
+import json
+from flask import request, make_response
+from werkzeug.http import parse_etags
+
+# 'private': a resposta depende da sessão; 'no-cache': o navegador sempre revalida (If-None-Match)
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """ETag a partir das partes que definem o conteúdo (versão do cache, unidade, data, sessão...)."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def client_has_etag(etag: str) -> bool:
+    """
+    True se o If-None-Match da requisição contém este ETag.
+    O Flask-Compress acrescenta ':<algoritmo>' ao ETag das respostas comprimidas
+    ("abc" -> "abc:gzip"), então o sufixo é ignorado na comparação.
+    """
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    client_etags = parse_etags(header)
+    if client_etags.star_tag:
+        return True
+    return any(tag.split(':', 1)[0] == etag for tag in client_etags.as_set(include_weak=True))
+
+
+def not_modified(etag: str):
+    response = make_response('', 304)
+    return with_etag(response, etag)
+
+
+def with_etag(response, etag: str):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
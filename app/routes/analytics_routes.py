@@ -0,0 +1,86 @@
+# app/routes/analytics_routes.py
+from flask import Blueprint, render_template, request, session, redirect, url_for, jsonify
+from datetime import date, timedelta
+from cache_manager import load_daily_metrics
+from metrics import calculate_range_metrics, RANGE_GRANULARITIES
+
+analytics_bp = Blueprint('analytics', __name__, template_folder='../templates')
+
+# Período máximo de uma consulta (em dias)
+MAX_RANGE_DAYS = 366
+
+
+def _parse_range_args(args):
+    """Lê e valida período, unidades e granularidade da query string. Retorna (params, erro)."""
+    try:
+        end_date = date.fromisoformat(args.get('end', date.today().isoformat()))
+        start_date = date.fromisoformat(args.get('start', (end_date - timedelta(days=29)).isoformat()))
+    except ValueError:
+        return None, "Datas inválidas (use AAAA-MM-DD)."
+    if start_date > end_date:
+        return None, "A data inicial deve ser anterior à final."
+    if (end_date - start_date).days + 1 > MAX_RANGE_DAYS:
+        return None, f"O período máximo é de {MAX_RANGE_DAYS} dias."
+
+    # Só unidades que o usuário pode ver; por padrão, a unidade selecionada
+    allowed_units = session.get('unidades', {})
+    requested = [u for u in args.get('units', '').split(',') if u] or [session.get('selected_unit_id')]
+    unit_ids = [u for u in requested if u in allowed_units]
+    if not unit_ids:
+        return None, "Nenhuma unidade válida selecionada."
+
+    granularity = args.get('granularity', 'day')
+    if granularity not in RANGE_GRANULARITIES:
+        granularity = 'day'
+
+    return {"start": start_date, "end": end_date, "unit_ids": unit_ids, "granularity": granularity}, None
+
+
+@analytics_bp.route('/analytics')
+def analytics_page():
+    if 'username' not in session or not session.get('unidades'):
+        return redirect(url_for('auth.login'))
+
+    end_date = date.today()
+    return render_template('analytics.html',
+                           units=session['unidades'],
+                           selected_unit_id=session.get('selected_unit_id'),
+                           default_start=(end_date - timedelta(days=29)).isoformat(),
+                           default_end=end_date.isoformat())
+
+
+@analytics_bp.route('/api/analytics')
+def analytics_api():
+    if 'unidades' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    params, error = _parse_range_args(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Uma leitura das contagens materializadas (agendas_daily_metrics); as contas são feitas num DataFrame só
+    rows = load_daily_metrics(params["unit_ids"], params["start"], params["end"])
+    result = calculate_range_metrics(rows, params["granularity"])
+
+    expected_days = (params["end"] - params["start"]).days + 1
+    dates_by_unit = {}
+    for row in rows:
+        dates_by_unit.setdefault(str(row['unit_id']), set()).add(row['target_date'])
+    cached_days = {unit_id: len(dates) for unit_id, dates in dates_by_unit.items()}
+
+    unidades = session['unidades']
+    for item in result["by_unit"] + result["by_unit_period"] + result["by_professional"]:
+        item["unit_name"] = unidades.get(item["unit_id"], f"ID {item['unit_id']}")
+
+    result.update({
+        "start": params["start"].isoformat(),
+        "end": params["end"].isoformat(),
+        "granularity": params["granularity"],
+        # Dias sem cache não entram nas contas: a tela avisa quantos faltam por unidade
+        "coverage": [
+            {"unit_id": u, "unit_name": unidades.get(u, f"ID {u}"),
+             "cached_days": cached_days.get(u, 0), "expected_days": expected_days}
+            for u in params["unit_ids"]
+        ],
+    })
+    return jsonify(result)
@@ -1,21 +1,43 @@
 # app/routes/api_routes.py
-from flask import Blueprint, jsonify, session
+import os
+import json
+import threading
+import time
+from datetime import date
+from flask import Blueprint, jsonify, session, request, current_app, Response, stream_with_context
 from login_auth import get_auth_new
-from app.services.amei_api import get_patient_details, get_appointment_details
+from app.services.details_cache import get_details_cached, fetch_slot_details
+from cache_manager import wait_for_cache_write, load_cache_version
+from app.http_cache import make_etag, client_has_etag, not_modified, with_etag
 
 api_bp = Blueprint('api', __name__)
 
+# --- EVENTOS DE CACHE (SSE) ---
+# Cada conexão fica presa a uma thread do worker (gthread, ver Procfile). Para não esgotar as
+# threads das requisições normais, no máximo SSE_MAX_STREAMS conexões ficam abertas por
+# processo; as demais viram polling: recebem a versão atual e fecham na hora, e o navegador
+# reconecta depois de SSE_FALLBACK_RETRY_MS.
+SSE_MAX_DURATION = int(os.environ.get("SSE_MAX_DURATION", "300"))   # segundos; o navegador reconecta sozinho
+SSE_POLL_INTERVAL = int(os.environ.get("SSE_POLL_INTERVAL", "10"))  # segundos entre consultas ao Supabase
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "8"))       # por processo; deixe threads livres
+SSE_RETRY_MS = 5000
+SSE_FALLBACK_RETRY_MS = int(os.environ.get("SSE_FALLBACK_RETRY_MS", "30000"))
+
+_sse_streams = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+# Última versão consultada por (unidade, dia): abas abertas no mesmo dia dividem a consulta
+_version_cache: dict[tuple, tuple[float, dict | None]] = {}
+_version_cache_lock = threading.Lock()
+
+def _amei_headers(id_unidade):
+    auth = get_auth_new(id_unidade)
+    return {'Authorization': f"Bearer {auth}", 'Cookie': current_app.config['COOKIE_VALUE']}
+
 @api_bp.route('/api/patient_details/<int:patient_id>')
 def patient_details_api(patient_id):
     if 'selected_unit_id' not in session: return jsonify({"error": "Unauthorized"}), 401
     
     id_unidade_selecionada = session['selected_unit_id']
-    auth = get_auth_new(id_unidade_selecionada)
-    
-    from flask import current_app
-    HEADERS = {'Authorization': f"Bearer {auth}", 'Cookie': current_app.config['COOKIE_VALUE']}
-    
-    details = get_patient_details(patient_id, HEADERS)
+    details = get_details_cached("patient", id_unidade_selecionada, patient_id, _amei_headers(id_unidade_selecionada))
     
     if details: return jsonify(details)
     else: return jsonify({"error": "Paciente não encontrado"}), 404
@@ -25,20 +47,38 @@ def appointment_details_api(appointment_id):
     if 'selected_unit_id' not in session: return jsonify({"error": "Unauthorized"}), 401
     
     id_unidade_selecionada = session['selected_unit_id']
-    auth = get_auth_new(id_unidade_selecionada)
-
-    from flask import current_app
-    HEADERS = {'Authorization': f"Bearer {auth}", 'Cookie': current_app.config['COOKIE_VALUE']}
-    
-    details = get_appointment_details(appointment_id, HEADERS)
+    details = get_details_cached("appointment", id_unidade_selecionada, appointment_id, _amei_headers(id_unidade_selecionada))
     
     if details: return jsonify(details)
     else: return jsonify({"error": "Agendamento não encontrado"}), 404
 
+# Popup da agenda: agendamento e paciente em uma chamada, buscados ao mesmo tempo
+@api_bp.route('/api/slot_details')
+def slot_details_api():
+    if 'selected_unit_id' not in session: return jsonify({"error": "Unauthorized"}), 401
+
+    appointment_id = request.args.get('appointment_id', type=int)
+    patient_id = request.args.get('patient_id', type=int)
+    if not appointment_id and not patient_id:
+        return jsonify({"error": "Informe appointment_id e/ou patient_id"}), 400
+
+    id_unidade_selecionada = session['selected_unit_id']
+    appointment, patient = fetch_slot_details(id_unidade_selecionada, appointment_id, patient_id,
+                                              _amei_headers(id_unidade_selecionada))
+
+    if not appointment and not patient:
+        return jsonify({"error": "Detalhes não encontrados"}), 404
+    return jsonify({"appointment": appointment, "patient": patient})
+
 @api_bp.route('/api/my_units')
 def my_units_api():
     if 'unidades' not in session:
         return jsonify({"error": "Unauthorized"}), 401
+
+    # A lista só muda quando as unidades da sessão mudam
+    etag = make_etag(sorted(session['unidades'].items()))
+    if client_has_etag(etag):
+        return not_modified(etag)
     
     # Retorna as unidades do usuário já em ordem alfabética pelo nome
     sorted_unidades = sorted(session['unidades'].items(), key=lambda item: item[1])
@@ -46,4 +86,92 @@ def my_units_api():
     # Formata como uma lista de objetos para o JavaScript
     units_list = [{"id": unit_id, "name": unit_name} for unit_id, unit_name in sorted_unidades]
     
-    return jsonify(units_list)
\ No newline at end of file
+    return with_etag(jsonify(units_list), etag)
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _shared_cache_version(unit_id, target_date: date, max_age: float) -> dict | None:
+    """load_cache_version com reaproveitamento por até 'max_age' segundos entre as conexões do processo."""
+    key = (str(unit_id), target_date)
+    now = time.monotonic()
+    with _version_cache_lock:
+        cached = _version_cache.get(key)
+        if cached and now - cached[0] < max_age:
+            return cached[1]
+    version = load_cache_version(unit_id, target_date)
+    with _version_cache_lock:
+        _version_cache[key] = (time.monotonic(), version)
+    return version
+
+
+def _changed_professionals(old_hashes, new_hashes):
+    """(alterados, removidos) entre duas versões; (None, []) quando não dá para comparar (= todos)."""
+    if old_hashes is None or new_hashes is None:
+        return None, []
+    changed = [pid for pid, h in new_hashes.items() if old_hashes.get(pid) != h]
+    removed = [pid for pid in old_hashes if pid not in new_hashes]
+    return changed, removed
+
+
+# Avisa o index.html quando o cache do dia aberto é regravado, com os profissionais que mudaram.
+# Gravações feitas neste processo acordam a conexão na hora; as de outros workers (ou do
+# update_cache_script) são vistas na próxima consulta leve da versão, a cada SSE_POLL_INTERVAL.
+@api_bp.route('/api/cache_events')
+def cache_events_api():
+    if 'selected_unit_id' not in session: return jsonify({"error": "Unauthorized"}), 401
+
+    # A sessão só pode ser lida antes de começar o stream
+    id_unidade_selecionada = session['selected_unit_id']
+    try:
+        selected_date = date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        return jsonify({"error": "Data inválida"}), 400
+    since = request.args.get('since') or None
+
+    def _initial_event(current):
+        # A página foi renderizada com outra versão: não sabemos o que mudou, atualiza tudo
+        return _sse_event('cache_updated', {"last_updated_iso": current['last_updated_iso'],
+                                            "changed_professionals": None, "removed_professionals": []})
+
+    def generate():
+        # O limite é conferido aqui (e não antes do Response) para que o 'finally' sempre libere a vaga
+        if not _sse_streams.acquire(blocking=False):
+            yield f"retry: {SSE_FALLBACK_RETRY_MS}\n\n"
+            current = _shared_cache_version(id_unidade_selecionada, selected_date, SSE_POLL_INTERVAL)
+            if current and current['last_updated_iso'] != since:
+                yield _initial_event(current)
+            return
+
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            deadline = time.monotonic() + SSE_MAX_DURATION
+            last_seen = wait_for_cache_write(id_unidade_selecionada, selected_date, None, 0)
+
+            current = _shared_cache_version(id_unidade_selecionada, selected_date, SSE_POLL_INTERVAL)
+            if current and current['last_updated_iso'] != since:
+                yield _initial_event(current)
+
+            while time.monotonic() < deadline:
+                previous_seen = last_seen
+                last_seen = wait_for_cache_write(id_unidade_selecionada, selected_date, last_seen,
+                                                 min(SSE_POLL_INTERVAL, max(0.0, deadline - time.monotonic())))
+                # Gravação neste processo: consulta agora; senão, reaproveita a consulta de outra aba
+                max_age = 0 if last_seen != previous_seen else SSE_POLL_INTERVAL
+                latest = _shared_cache_version(id_unidade_selecionada, selected_date, max_age)
+                if latest and latest['last_updated_iso'] != (current or {}).get('last_updated_iso'):
+                    changed, removed = _changed_professionals((current or {}).get('schedule_hashes'),
+                                                              latest.get('schedule_hashes'))
+                    current = latest
+                    yield _sse_event('cache_updated', {"last_updated_iso": latest['last_updated_iso'],
+                                                       "changed_professionals": changed,
+                                                       "removed_professionals": removed})
+                else:
+                    # Mantém a conexão viva em proxies e detecta cliente desconectado
+                    yield ": ping\n\n"
+        finally:
+            _sse_streams.release()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -18,7 +18,8 @@ def login():
         
         # 3. LÓGICA ATUALIZADA:
         # Busca o usuário DIRETAMENTE no Firestore
-        user_data = get_user(username)
+        # Sempre do Supabase: o cache de usuários não tem o hash e pode estar atrasado em outro worker
+        user_data = get_user(username, use_cache=False)
 
         # A MÁGICA ACONTECE AQUI: Compara o hash salvo com a senha digitada 🔐
         if user_data and 'password_hash' in user_data and check_password_hash(user_data['password_hash'], password):
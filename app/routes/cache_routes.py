@@ -1,14 +1,16 @@
 # app/routes/cache_routes.py
 from flask import Blueprint, request, jsonify, session
-from datetime import date, datetime
-from update_cache_script import process_and_cache_day
+from datetime import date
+from app.services.cache_jobs import enqueue_day_refresh, get_job
 from app.activity_logger import log_activity
 
 cache_bp = Blueprint('cache', __name__)
 
-# ROTA CORRIGIDA: SEM THREAD, EXECUÇÃO SÍNCRONA
-@cache_bp.route('/force_update_day_cache', methods=['POST'])
-def force_update_day_cache_sync():
+# A atualização roda em background: o POST só agenda o job e retorna o ID,
+# o navegador acompanha o progresso em GET /api/cache_jobs/<job_id>.
+# (Sob /api/: o hook de log de app/__init__.py não registra cada consulta de progresso.)
+@cache_bp.route('/api/cache_jobs', methods=['POST'])
+def create_cache_job():
     # Pega o ID da unidade do formulário enviado pelo JavaScript
     id_unidade = request.form.get('unit_id')
     if not id_unidade:
@@ -17,27 +19,28 @@ def force_update_day_cache_sync():
     # Verifica se o usuário tem permissão para esta unidade
     if 'unidades' not in session or id_unidade not in session['unidades']:
         return jsonify({"status": "error", "message": "Acesso não autorizado para esta unidade."}), 403
-        
+
     selected_date_str = request.form.get('selected_date_force_update', date.today().strftime('%Y-%m-%d'))
     selected_date = date.fromisoformat(selected_date_str)
     unit_name = session['unidades'].get(id_unidade, f"ID {id_unidade}")
     user = session.get('username')
 
-    try:
+    job, created = enqueue_day_refresh(id_unidade, selected_date, unit_name=unit_name, requested_by=user)
+
+    if created:
         log_activity("CACHE_FORCED_UPDATE", f"Usuário '{user}' forçou atualização da unidade '{unit_name}' para o dia {selected_date_str}")
-        print(f"Iniciando atualização para o dia {selected_date} na unidade {unit_name} (ID: {id_unidade}).")
-        
-        process_and_cache_day(selected_date, id_unidade)
-        
-        print(f"Atualização para o dia {selected_date} na unidade {unit_name} finalizada.")
-        
-        return jsonify({
-            "status": "success", 
-            "message": f"Cache para a unidade {unit_name} atualizado!"
-        })
-    except Exception as e:
-        print(f"Erro durante a atualização do cache para {unit_name}: {e}")
-        return jsonify({
-            "status": "error",
-            "message": f"Erro ao atualizar o cache da unidade {unit_name}."
-        }), 500
\ No newline at end of file
+        print(f"Atualização agendada para o dia {selected_date} na unidade {unit_name} (ID: {id_unidade}). Job: {job['id']}")
+
+    return jsonify({
+        "status": "queued" if created else job['status'],
+        "job_id": job['id'],
+        "message": f"Atualização da unidade {unit_name} {'agendada' if created else 'já estava em andamento'}."
+    }), 202
+
+
+@cache_bp.route('/api/cache_jobs/<job_id>')
+def cache_job_status(job_id):
+    job = get_job(job_id)
+    if not job or job['unit_id'] not in session.get('unidades', {}):
+        return jsonify({"status": "error", "message": "Job não encontrado."}), 404
+    return jsonify(job)
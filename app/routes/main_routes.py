@@ -1,22 +1,29 @@
 # app/routes/main_routes.py
 
-from flask import Blueprint, render_template, request, session, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, session, redirect, url_for, flash, current_app, jsonify, make_response
+import os
+import copy
 from datetime import date, datetime
-import pandas as pd
+from zoneinfo import ZoneInfo
 from login_auth import get_auth_new
-from cache_manager import load_agendas_from_cache_v2, save_agendas_to_cache_v2
+from cache_manager import load_agendas_from_cache_v2, save_agendas_delta_v2, load_cache_version, peek_cache_version
 # Importando as novas funções de forma organizada
-from metrics import (
-    calculate_summary_metrics, 
-    calculate_confirmation_ranking,
-    calculate_occupation_ranking,
-    calculate_conversion_ranking,
-    calculate_global_conversion_rate
-)
+from metrics import build_view_model, METRICS_VERSION
 from app.services.amei_api import get_all_professionals, get_slots_for_professional
+from slot_fetcher import fetch_slots_concurrently
+from single_flight import run_single_flight
+from app.services.cache_jobs import enqueue_day_refresh
+from app.http_cache import make_etag, client_has_etag, not_modified, with_etag
 
 main_bp = Blueprint('main', __name__, template_folder='../templates')
 
+SAO_PAULO_TZ = ZoneInfo("America/Sao_Paulo")
+
+# Idade máxima (em segundos) do cache antes de disparar uma atualização em background.
+# O dia de hoje muda o tempo todo; os demais dias mudam bem menos.
+CACHE_MAX_AGE_TODAY = int(os.environ.get("CACHE_MAX_AGE_TODAY", "600"))
+CACHE_MAX_AGE_OTHER_DAYS = int(os.environ.get("CACHE_MAX_AGE_OTHER_DAYS", "3600"))
+
 AGENDA_URL_TEMPLATE = "https://amei.amorsaude.com.br/schedule/schedule-appointment?profissionalId={}&date={}"
 STATUS_STYLES = {
     "Livre": "background-color: #eeeeee; border: 1px solid #7cb9e8; color: #1565C0;",
@@ -40,17 +47,58 @@ def _get_default_context():
         "agendas": {}, "resumo_geral": {}, "resumo_html": "", "table_headers": [], "table_index": [], "table_body": [],
         "summary_metrics": {"total_agendado_geral": 0, "percentual_confirmacao": "0%", "total_confirmado_geral": 0, "percentual_ocupacao": "0%", "total_ocupados": 0, "total_slots_disponiveis": 0},
         "profissionais_stats_confirmacao": [], "profissionais_stats_ocupacao": [], "profissionais_stats_conversao": [],
-        "conversion_data_for_selected_day": {"conversion_rate": "0.00%", "total_atendidos": 0}
+        "conversion_data_for_selected_day": {"conversion_rate": "0.00%", "total_atendidos": 0},
+        "cache_age_minutes": None, "background_refresh_job_id": None
     }
 
-def _prepare_ranking_data(stats_list, key_name):
-    """Adiciona o valor numérico da porcentagem para a barra de progresso no HTML."""
-    for stat in stats_list:
-        try:
-            stat['percent_numeric'] = float(stat[key_name].strip('%'))
-        except (ValueError, KeyError):
-            stat['percent_numeric'] = 0
-    return stats_list
+def _cache_age_seconds(last_updated_iso):
+    """Idade do cache em segundos (None se 'last_updated_iso' for inválido)."""
+    try:
+        last_updated = datetime.fromisoformat(last_updated_iso)
+    except (ValueError, TypeError):
+        return None
+    if last_updated.tzinfo is None:
+        # Entradas antigas foram gravadas sem fuso; assume horário de São Paulo
+        last_updated = last_updated.replace(tzinfo=SAO_PAULO_TZ)
+    return max(0, (datetime.now(SAO_PAULO_TZ) - last_updated).total_seconds())
+
+def _is_cache_stale(selected_date, last_updated_iso, age_seconds):
+    """Decide se o cache de um dia deve ser revalidado em background."""
+    if age_seconds is None:
+        return True
+    today = datetime.now(SAO_PAULO_TZ).date()
+    if selected_date < today:
+        # Dia passado atualizado depois de encerrado: não muda mais
+        last_updated = datetime.fromisoformat(last_updated_iso)
+        if last_updated.date() > selected_date:
+            return False
+    max_age = CACHE_MAX_AGE_TODAY if selected_date == today else CACHE_MAX_AGE_OTHER_DAYS
+    return age_seconds > max_age
+
+def _ensure_view_model(context):
+    # --- MÉTRICAS ---
+    # O cache já traz o view model pronto (métricas, rankings e tabela). Só recalcula
+    # quando a entrada foi gravada por uma versão anterior da lógica de metrics.py.
+    if context["resumo_geral"] and context.get('metrics_version', 0) < METRICS_VERSION:
+        print(f"AVISO: Métricas do cache desatualizadas (versão {context.get('metrics_version', 0)}). Recalculando.")
+        context.update(build_view_model(context["resumo_geral"]))
+
+def _format_last_updated(last_updated_iso):
+    try:
+        return datetime.fromisoformat(last_updated_iso).strftime('%H:%M - %d/%m/%Y')
+    except (ValueError, TypeError):
+        return None
+
+def _index_etag(unit_id, selected_date_str, last_updated_iso, age_seconds):
+    """
+    Tudo que muda o HTML do index sem mudar o cache do dia: a sessão (usuário, papel, lista de
+    unidades) e o texto "(há N min)". Mensagens flash pendentes nunca recebem 304.
+    """
+    if session.get('_flashes'):
+        return None
+    return make_etag(unit_id, selected_date_str, last_updated_iso, METRICS_VERSION,
+                     int(age_seconds // 60), session.get('username'), session.get('role'),
+                     sorted(session.get('unidades', {}).items()))
 
 @main_bp.route('/', methods=['GET', 'POST'])
 def index():
@@ -64,19 +112,47 @@ def index():
     selected_date = date.fromisoformat(selected_date_str)    
 
     
+    # --- GET CONDICIONAL ---
+    # Descobre só a versão do cache: da memória/disco local quando o dia está lá (sem rede),
+    # senão com a consulta leve ao Supabase. Se o navegador já tem a página desta versão,
+    # responde 304 sem carregar os dados nem renderizar. Cache velho sempre renderiza,
+    # para disparar a atualização em background.
+    etag = None
+    cache_version = None
+    if request.method == 'GET':
+        known_version = peek_cache_version(id_unidade_selecionada, selected_date)
+        cache_version = ({"last_updated_iso": known_version} if known_version
+                         else load_cache_version(id_unidade_selecionada, selected_date))
+    if cache_version and cache_version.get('last_updated_iso'):
+        age_seconds = _cache_age_seconds(cache_version['last_updated_iso'])
+        if not _is_cache_stale(selected_date, cache_version['last_updated_iso'], age_seconds):
+            etag = _index_etag(id_unidade_selecionada, selected_date_str, cache_version['last_updated_iso'], age_seconds)
+            if etag and client_has_etag(etag):
+                return not_modified(etag)
+
     context = _get_default_context()
-    cached_data = load_agendas_from_cache_v2(selected_date, id_unidade_selecionada)
+    cached_data = load_agendas_from_cache_v2(selected_date, id_unidade_selecionada,
+                                             expected_version=cache_version['last_updated_iso'] if cache_version else None)
 
     if cached_data and cached_data.get('agendas'):
         print(f"SUCESSO: Usando dados do cache para {selected_date_str}.")
         context.update(cached_data)
 
         if context.get('last_updated_iso'):
-            try:
-                dt_object = datetime.fromisoformat(context['last_updated_iso'])
-                context['last_updated_formatted'] = dt_object.strftime('%H:%M - %d/%m/%Y')
-            except (ValueError, TypeError):
-                context['last_updated_formatted'] = None
+            context['last_updated_formatted'] = _format_last_updated(context['last_updated_iso'])
+
+        # --- STALE-WHILE-REVALIDATE ---
+        # Serve o cache na hora; se estiver velho, agenda a atualização em background.
+        # Vários usuários vendo o mesmo dia caem no mesmo job (enqueue_day_refresh agrupa).
+        age_seconds = _cache_age_seconds(context.get('last_updated_iso'))
+        context['cache_age_minutes'] = int(age_seconds // 60) if age_seconds is not None else None
+        if _is_cache_stale(selected_date, context.get('last_updated_iso'), age_seconds):
+            unit_name = session.get('unidades', {}).get(id_unidade_selecionada)
+            job, created = enqueue_day_refresh(id_unidade_selecionada, selected_date, unit_name=unit_name,
+                                               requested_by=session.get('username'))
+            context['background_refresh_job_id'] = job['id']
+            if created:
+                print(f"AVISO: Cache de {selected_date_str} com {context['cache_age_minutes']} min. Atualizando em background (job {job['id']}).")
 
     else:
         auth = get_auth_new(id_unidade_selecionada)
@@ -86,93 +162,136 @@ def index():
         
         HEADERS = {'Authorization': f"Bearer {auth}", 'Cookie': current_app.config['COOKIE_VALUE']}
 
-        print(f"AVISO: Cache não encontrado ou inválido para {selected_date_str}. Buscando da API.")
-        all_profissionais = get_all_professionals(HEADERS)
-        if all_profissionais:
-            for prof in all_profissionais:
-                prof_id = prof.get('id')
-                prof_nome = prof.get('nome', f'ID {prof_id}')
-                
-                slots = get_slots_for_professional(prof_id, selected_date, id_unidade_selecionada, HEADERS)
-                
-                # REMOVA ESTA CONDIÇÃO PARA INCLUIR TODOS OS PROFISSIONAIS
-                # if any(slot.get('status') not in ["Livre", "Bloqueado"] for slot in slots):
-                
-                # SEMPRE inclui o profissional, mesmo que tenha apenas horários livres
-                context["agendas"][prof_nome] = {
-                    "id": prof_id,
-                    "nome": prof_nome,
-                    "horarios": sorted(slots, key=lambda x: x.get('numeric_hour', 0.0))
-                }
-                
-                # --- LÓGICA DE CONTAGEM ATUALIZADA PARA ENVIAR AMBOS OS STATUS ---
-                contagem_status = {}
-                for slot in slots:
-                    main_status = slot.get('status')
-                    app_status = slot.get('appointmentStatus')
+        def _crawl_day():
+            day_context = {"agendas": {}, "resumo_geral": {}}
+            print(f"AVISO: Cache não encontrado ou inválido para {selected_date_str}. Buscando da API.")
+            all_profissionais = get_all_professionals(HEADERS)
+            if all_profissionais:
+                # Busca os horários de todos os profissionais em paralelo (ordem preservada)
+                slots_por_profissional = fetch_slots_concurrently(
+                    all_profissionais,
+                    lambda prof_id: get_slots_for_professional(prof_id, selected_date, id_unidade_selecionada, HEADERS)
+                )
+
+                for prof, slots in slots_por_profissional:
+                    prof_id = prof.get('id')
+                    prof_nome = prof.get('nome', f'ID {prof_id}')
                     
-                    final_key = main_status # Define o status base
+                    # REMOVA ESTA CONDIÇÃO PARA INCLUIR TODOS OS PROFISSIONAIS
+                    # if any(slot.get('status') not in ["Livre", "Bloqueado"] for slot in slots):
                     
-                    # Se 'appointmentStatus' existir, ele representa o resultado final da consulta.
-                    # Se o slot for um 'Encaixe', preservamos essa informação.
-                    if app_status:
-                        if main_status == 'Encaixe':
-                            # Cria uma chave combinada, ex: "Encaixe (Atendido)"
-                            final_key = f"Encaixe ({app_status})"
-                        else:
-                            # Para agendamentos normais, o resultado final é o que importa
-                            final_key = app_status
-
-                    if final_key:
-                        contagem_status[final_key] = contagem_status.get(final_key, 0) + 1
-
-                context["resumo_geral"][prof_nome] = contagem_status
+                    # SEMPRE inclui o profissional, mesmo que tenha apenas horários livres
+                    day_context["agendas"][prof_nome] = {
+                        "id": prof_id,
+                        "nome": prof_nome,
+                        "horarios": sorted(slots, key=lambda x: x.get('numeric_hour', 0.0))
+                    }
                     
-            if context.get("agendas"):
+                    # --- LÓGICA DE CONTAGEM ATUALIZADA PARA ENVIAR AMBOS OS STATUS ---
+                    contagem_status = {}
+                    for slot in slots:
+                        main_status = slot.get('status')
+                        app_status = slot.get('appointmentStatus')
+                        
+                        final_key = main_status # Define o status base
+                        
+                        # Se 'appointmentStatus' existir, ele representa o resultado final da consulta.
+                        # Se o slot for um 'Encaixe', preservamos essa informação.
+                        if app_status:
+                            if main_status == 'Encaixe':
+                                # Cria uma chave combinada, ex: "Encaixe (Atendido)"
+                                final_key = f"Encaixe ({app_status})"
+                            else:
+                                # Para agendamentos normais, o resultado final é o que importa
+                                final_key = app_status
+
+                        if final_key:
+                            contagem_status[final_key] = contagem_status.get(final_key, 0) + 1
 
-                now = datetime.now()
-                context['last_updated_iso'] = now.isoformat() # Formato para o computador
-                context['last_updated_formatted'] = now.strftime('%H:%M - %d/%m/%Y') # Formato para exibição
+                    day_context["resumo_geral"][prof_nome] = contagem_status
                 
-                save_agendas_to_cache_v2(context, selected_date, id_unidade_selecionada)
-        else:
-            print("ERRO: A chamada get_all_professionals não retornou dados.")
+                if day_context.get("agendas"):
 
-    # --- CÁLCULO DAS MÉTRICAS (SEMPRE EXECUTA) ---
-    if context["resumo_geral"]:
-        df_resumo = pd.DataFrame.from_dict(context["resumo_geral"], orient='index').fillna(0).astype(int)
-        
-        # Calcula todas as métricas usando as novas funções
-        context["summary_metrics"] = calculate_summary_metrics(context["resumo_geral"], df_resumo.copy())
-        context["conversion_data_for_selected_day"] = calculate_global_conversion_rate(df_resumo.copy())
-        context["profissionais_stats_confirmacao"] = calculate_confirmation_ranking(df_resumo.copy())
-        context["profissionais_stats_ocupacao"] = calculate_occupation_ranking(df_resumo.copy())
-        context["profissionais_stats_conversao"] = calculate_conversion_ranking(df_resumo.copy())
-
-        if not df_resumo.empty:
-            df_pivot = df_resumo.T
-            
-            total_agendado = {}
-            for profissional in df_pivot.columns:
-                total_slots = df_pivot[profissional].sum()
-                livres = df_pivot.loc['Livre', profissional] if 'Livre' in df_pivot.index else 0
-                bloqueados = df_pivot.loc['Bloqueado', profissional] if 'Bloqueado' in df_pivot.index else 0
-                total_agendado[profissional] = int(total_slots - livres - bloqueados)
-            
-            df_pivot.loc['Total Agendado'] = pd.Series(total_agendado)
-            
-            # --- AQUI ESTÁ A MUDANÇA PRINCIPAL ---
-            # Em vez de gerar HTML, preparamos os dados para o Jinja2
-            context['table_headers'] = df_pivot.columns.tolist()
-            context['table_index'] = df_pivot.index.tolist()
-            context['table_body'] = df_pivot.values.tolist()
-
-    # Prepara os dados para as barras de progresso
-    context["profissionais_stats_confirmacao"] = _prepare_ranking_data(context.get("profissionais_stats_confirmacao", []), 'taxa_confirmacao')
-    context["profissionais_stats_ocupacao"] = _prepare_ranking_data(context.get("profissionais_stats_ocupacao", []), 'taxa_ocupacao')
-    context["profissionais_stats_conversao"] = _prepare_ranking_data(context.get("profissionais_stats_conversao", []), 'taxa_conversao')
-
-    return render_template('index.html', selected_date=selected_date_str, status_styles=STATUS_STYLES, agenda_url_template=AGENDA_URL_TEMPLATE, **context)
+                    now = datetime.now(SAO_PAULO_TZ)
+                    day_context['last_updated_iso'] = now.isoformat() # Formato para o computador
+                    day_context['last_updated_formatted'] = now.strftime('%H:%M - %d/%m/%Y') # Formato para exibição
+                    day_context.update(build_view_model(day_context["resumo_geral"]))
+                    
+                    save_agendas_delta_v2(day_context, selected_date, id_unidade_selecionada)
+                    return day_context
+            else:
+                print("ERRO: A chamada get_all_professionals não retornou dados.")
+            return None
+
+        def _recheck_cache():
+            # Outro worker pode ter acabado de buscar e salvar este mesmo dia
+            recheck_data = load_agendas_from_cache_v2(selected_date, id_unidade_selecionada)
+            return recheck_data if recheck_data and recheck_data.get('agendas') else None
+
+        # Só uma busca por (unidade, dia) roda por vez; as outras requisições esperam e reutilizam o resultado
+        fresh_data = run_single_flight(
+            f"{id_unidade_selecionada}:{selected_date_str}", _crawl_day, recheck=_recheck_cache
+        )
+        if fresh_data:
+            # Cópia: o mesmo resultado pode ter sido entregue a outras requisições simultâneas
+            context.update(copy.deepcopy(fresh_data))
+
+    _ensure_view_model(context)
+
+    response = make_response(render_template('index.html', selected_date=selected_date_str, status_styles=STATUS_STYLES, agenda_url_template=AGENDA_URL_TEMPLATE, **context))
+    # O ETag só vale se a página foi montada com a mesma versão consultada acima
+    if etag and context.get('last_updated_iso') == cache_version['last_updated_iso']:
+        with_etag(response, etag)
+    return response
+
+
+# Trechos da página já renderizados, para o navegador se atualizar sozinho quando
+# /api/cache_events avisa que o cache do dia foi regravado (sem recarregar a página).
+@main_bp.route('/api/day_fragments')
+def day_fragments():
+    if 'selected_unit_id' not in session: return jsonify({"error": "Unauthorized"}), 401
+
+    id_unidade_selecionada = session['selected_unit_id']
+    try:
+        selected_date = date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        return jsonify({"error": "Data inválida"}), 400
+    selected_date_str = selected_date.strftime('%Y-%m-%d')
+
+    # 'professional_ids' vazio = todos os profissionais
+    requested_ids = {pid for pid in request.args.get('professional_ids', '').split(',') if pid}
+
+    cached_data = load_agendas_from_cache_v2(selected_date, id_unidade_selecionada,
+                                             expected_version=request.args.get('version') or None)
+    if not cached_data or not cached_data.get('agendas'):
+        return jsonify({"error": "Cache não encontrado"}), 404
+
+    context = _get_default_context()
+    context.update(cached_data)
+    _ensure_view_model(context)
+    render_args = dict(context, selected_date=selected_date_str, status_styles=STATUS_STYLES,
+                       agenda_url_template=AGENDA_URL_TEMPLATE)
+
+    columns, order = {}, []
+    for profissional, agenda_data in context['agendas'].items():
+        prof_id = str(agenda_data.get('id'))
+        if not agenda_data.get('horarios'):
+            continue
+        order.append(prof_id)
+        if not requested_ids or prof_id in requested_ids:
+            columns[prof_id] = render_template('partials/_agenda_column.html', profissional=profissional,
+                                               agenda_data=agenda_data, **render_args)
+
+    return jsonify({
+        "version": context.get('last_updated_iso'),
+        "last_updated_formatted": _format_last_updated(context.get('last_updated_iso')),
+        "summary_html": render_template('partials/_day_summary.html', **render_args),
+        "table_html": render_template('partials/_day_table.html', **render_args),
+        "rankings_html": render_template('partials/_day_rankings.html', **render_args),
+        "columns": columns,
+        # Ordem das colunas com horários; as que não aparecem aqui devem ser removidas
+        "order": order,
+    })
 
 
 @main_bp.route('/switch_unit/<direction>')
@@ -1,23 +1,26 @@
 # app/routes/superadmin_routes.py
-from flask import Blueprint, render_template, request, session, redirect, url_for, flash
+from flask import Blueprint, render_template, request, session, redirect, url_for, flash, jsonify
 from functools import wraps
 from datetime import date, datetime, timedelta
-import pandas as pd
-import sqlite3
 import io
-from flask import Response
+import os
+from flask import Response, stream_with_context
+import csv
+import itertools
+import re
+import zipfile
+from xml.sax.saxutils import escape
 from zoneinfo import ZoneInfo
 
-
-from firebase_admin import firestore
 # Importe suas funções de métricas e cache
-from cache_manager import load_agendas_from_cache_v2
-from metrics import (
-    calculate_summary_metrics, 
-    calculate_global_conversion_rate
-)
+from cache_manager import load_unit_metrics_totals, get_memory_cache_stats
+from metrics import counts_rates
+from app.activity_logger import (query_activity_log, get_activity_log_filter_options, iter_activity_log,
+                                 get_activity_log_stats)
+from app.services.details_cache import get_details_cache_stats
 
 SAO_PAULO_TZ = ZoneInfo("America/Sao_Paulo") # <-- MUDANÇA 2: Definir fuso horário
+ACTIVITY_LOG_PAGE_SIZE = 100  # registros por página no visualizador do log
 
 
 superadmin_bp = Blueprint('superadmin', __name__, template_folder='../templates')
@@ -49,39 +52,36 @@ def dashboard():
 
     # IMPORTANTE: Este painel depende dos caches diários de cada unidade.
     # Ele não busca dados da API em tempo real para não sobrecarregar o sistema.
+    # Uma única consulta agregada (agendas_daily_metrics) traz as contagens de todas as unidades
+    totals_by_unit = load_unit_metrics_totals(list(all_units.keys()), selected_date, selected_date)
+
     for unit_id, unit_name in all_units.items():
-        cached_data = load_agendas_from_cache_v2(selected_date, unit_id)
+        counts = totals_by_unit.get(unit_id)
         
-        if cached_data and cached_data.get('resumo_geral'):
-            resumo_geral_unit = cached_data['resumo_geral']
-            df_resumo_unit = pd.DataFrame.from_dict(resumo_geral_unit, orient='index').fillna(0).astype(int)
-            
-            # Calcula métricas para esta unidade específica
-            summary_metrics = calculate_summary_metrics(resumo_geral_unit, df_resumo_unit.copy())
-            conversion_metrics = calculate_global_conversion_rate(df_resumo_unit.copy()) 
-            nao_compareceu = int(df_resumo_unit['Não compareceu'].sum()) if 'Não compareceu' in df_resumo_unit else 0
+        if counts and counts['total'] > 0:
+            rates = counts_rates(counts)
 
             # Adiciona os stats da unidade à lista
             all_units_stats.append({
                 'name': unit_name,
-                'agendados': summary_metrics['total_agendado_geral'],
-                'confirmacao': summary_metrics['percentual_confirmacao'],
-                'ocupacao': summary_metrics['percentual_ocupacao'],
-                'conversao': conversion_metrics['conversion_rate'],
-                'atendidos': conversion_metrics['total_atendidos'],
-                'nao_compareceu': nao_compareceu,
-                'confirmacao_numeric': float(summary_metrics['percentual_confirmacao'].strip('%')),
-                'ocupacao_numeric': float(summary_metrics['percentual_ocupacao'].strip('%')),
-                'conversao_numeric': float(conversion_metrics['conversion_rate'].strip('%')),
+                'agendados': counts['occupied'],
+                'confirmacao': f"{rates['taxa_confirmacao']:.2f}%",
+                'ocupacao': f"{rates['taxa_ocupacao']:.2f}%",
+                'conversao': f"{rates['taxa_conversao']:.2f}%",
+                'atendidos': counts['attended'],
+                'nao_compareceu': counts['no_show'],
+                'confirmacao_numeric': rates['taxa_confirmacao'],
+                'ocupacao_numeric': rates['taxa_ocupacao'],
+                'conversao_numeric': rates['taxa_conversao'],
             })
             
             # Acumula os totais para o resumo global
-            global_summary['total_agendado_geral'] += summary_metrics['total_agendado_geral']
-            global_summary['total_confirmado_geral'] += summary_metrics['total_confirmado_geral']
-            global_summary['total_ocupados'] += summary_metrics['total_ocupados']
-            global_summary['total_slots_disponiveis'] += summary_metrics['total_slots_disponiveis']
-            global_summary['total_atendidos'] += conversion_metrics['total_atendidos']
-            global_summary['total_nao_compareceu'] += nao_compareceu
+            global_summary['total_agendado_geral'] += counts['occupied']
+            global_summary['total_confirmado_geral'] += counts['confirmed']
+            global_summary['total_ocupados'] += counts['occupied']
+            global_summary['total_slots_disponiveis'] += counts['total']
+            global_summary['total_atendidos'] += counts['attended']
+            global_summary['total_nao_compareceu'] += counts['no_show']
 
 
     # Calcula as taxas globais
@@ -112,113 +112,185 @@ def dashboard():
     )
 
 
+@superadmin_bp.route('/superadmin/stats')
+@superadmin_required
+def runtime_stats():
+    """
+    Contadores internos do processo (worker do gunicorn) que atendeu a requisição:
+    cache em memória das agendas, cache de detalhes e fila do log de atividades.
+    """
+    return jsonify({
+        "pid": os.getpid(),
+        "memory_cache": get_memory_cache_stats(),
+        "details_cache": get_details_cache_stats(),
+        "activity_log": get_activity_log_stats(),
+    })
+
+
 @superadmin_bp.route('/superadmin/activity-log')
 @superadmin_required
 def activity_log():
-    db = firestore.client()
     current_filters = {
         'username': request.args.get('username', ''), 'action': request.args.get('action', ''),
         'start_date': request.args.get('start_date', ''), 'end_date': request.args.get('end_date', ''),
         'details': request.args.get('details', '')
     }
+    cursor = request.args.get('cursor') or None
+    next_cursor = None
 
     try:
-        query = db.collection('activity_log')
-        if current_filters['username']:
-            query = query.where('username', '==', current_filters['username'])
-        if current_filters['action']:
-            query = query.where('action', '==', current_filters['action'])
-        if current_filters['start_date']:
-            start_dt = datetime.fromisoformat(current_filters['start_date'])
-            query = query.where('timestamp', '>=', start_dt)
-        if current_filters['end_date']:
-            end_dt = datetime.fromisoformat(current_filters['end_date']) + timedelta(days=1)
-            query = query.where('timestamp', '<', end_dt)
-        
-        # Firestore não suporta busca 'LIKE'. Uma busca exata é possível.
-        if current_filters['details']:
-            query = query.where('details', '==', current_filters['details'])
-
-        query = query.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(500)
-        logs_from_db = query.stream()
-        
-        logs = []
-        for log in logs_from_db:
-            log_data = log.to_dict()
-            if 'timestamp' in log_data and isinstance(log_data['timestamp'], datetime):
-                # <-- MUDANÇA 3: Converte para o fuso de SP e formata
-                log_data['timestamp'] = log_data['timestamp'].astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S')
-            logs.append(log_data)
-
-        # Popula os menus de filtro
-        all_logs_docs = db.collection('activity_log').stream()
-        all_usernames_set = {doc.to_dict().get('username') for doc in all_logs_docs if doc.to_dict().get('username')}
-        
-        # Reset stream to re-iterate
-        all_logs_docs = db.collection('activity_log').stream()
-        all_actions_set = {doc.to_dict().get('action') for doc in all_logs_docs if doc.to_dict().get('action')}
+        # Uma página por vez, paginada por cursor (timestamp, id) nos índices do Supabase
+        logs, next_cursor = query_activity_log(current_filters, cursor=cursor, limit=ACTIVITY_LOG_PAGE_SIZE)
+        for log_data in logs:
+            if log_data.get('timestamp'):
+                # Converte para o fuso de SP e formata
+                log_data['timestamp'] = datetime.fromisoformat(log_data['timestamp']).astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S')
 
-        all_usernames = [{'username': name} for name in sorted(list(all_usernames_set))]
-        all_actions = [{'action': act} for act in sorted(list(all_actions_set))]
+        # Popula os menus de filtro (tabela de valores distintos mantida por trigger)
+        usernames, actions = get_activity_log_filter_options()
+        all_usernames = [{'username': name} for name in usernames]
+        all_actions = [{'action': act} for act in actions]
 
     except Exception as e:
-        flash(f"Erro ao carregar logs do Firestore: {e}", "danger")
+        flash(f"Erro ao carregar logs: {e}", "danger")
         logs, all_usernames, all_actions = [], [], []
 
     return render_template('activity_log.html', logs=logs, all_usernames=all_usernames,
-                           all_actions=all_actions, current_filters=current_filters)
+                           all_actions=all_actions, current_filters=current_filters,
+                           next_cursor=next_cursor, is_first_page=cursor is None,
+                           active_filters={k: v for k, v in current_filters.items() if v})
+
+
+EXPORT_COLUMNS = ['timestamp', 'username', 'ip_address', 'action', 'details']
+EXPORT_HEADERS = ['Data/Hora', 'Usuário', 'Endereço IP', 'Ação', 'Detalhes']
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def _export_rows(first_row, rows):
+    """Linhas da exportação já no fuso de SP, na ordem de EXPORT_COLUMNS."""
+    for log_data in itertools.chain([first_row], rows):
+        timestamp = log_data.get('timestamp')
+        if timestamp:
+            timestamp = datetime.fromisoformat(timestamp).astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S')
+        yield [timestamp] + [log_data.get(col) for col in EXPORT_COLUMNS[1:]]
+
+
+def _stream_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    buffer.write('\ufeff')  # BOM para o Excel reconhecer UTF-8
+    writer.writerow(EXPORT_HEADERS)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# --- XLSX EM STREAM ---
+# Um .xlsx é um zip de XMLs. O zipfile consegue gravar num destino sem seek (usa data
+# descriptors), então a planilha é escrita linha a linha e cada pedaço comprimido já vai
+# para a resposta: nada do arquivo fica em memória ou em disco. Todas as células são texto.
+_XLSX_STATIC_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Log_de_Atividades" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+# Caracteres de controle não são aceitos em XML (o Excel recusa o arquivo)
+_XML_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+class _ChunkSink(io.RawIOBase):
+    """Destino do zipfile: acumula os bytes gravados até o gerador repassá-los à resposta."""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def _xlsx_row(row) -> str:
+    cells = ''.join(
+        f'<c t="inlineStr"><is><t xml:space="preserve">{escape(_XML_ILLEGAL_CHARS.sub("", str(value)))}</t></is></c>'
+        if value not in (None, '') else '<c/>'
+        for value in row
+    )
+    return f'<row>{cells}</row>'
+
+
+def _stream_xlsx(rows):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as xlsx:
+        for name, content in _XLSX_STATIC_PARTS.items():
+            xlsx.writestr(name, content)
+        with xlsx.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            sheet.write(_xlsx_row(EXPORT_HEADERS).encode('utf-8'))
+            for row in rows:
+                sheet.write(_xlsx_row(row).encode('utf-8'))
+                if sum(map(len, sink.chunks)) >= EXPORT_CHUNK_SIZE:
+                    yield sink.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.take()
 
 
 @superadmin_bp.route('/superadmin/activity-log/export')
 @superadmin_required
 def export_activity_log():
-    db = firestore.client()
-    try:
-        # Reutiliza a mesma lógica de query da rota anterior, mas sem o .limit()
-        query = db.collection('activity_log')
-        if request.args.get('username'):
-            query = query.where('username', '==', request.args.get('username'))
-        if request.args.get('action'):
-            query = query.where('action', '==', request.args.get('action'))
-        if request.args.get('start_date'):
-            start_dt = datetime.fromisoformat(request.args.get('start_date'))
-            query = query.where('timestamp', '>=', start_dt)
-        if request.args.get('end_date'):
-            end_dt = datetime.fromisoformat(request.args.get('end_date')) + timedelta(days=1)
-            query = query.where('timestamp', '<', end_dt)
-        if request.args.get('details'):
-            query = query.where('details', '==', request.args.get('details'))
-        
-        query = query.order_by('timestamp', direction=firestore.Query.DESCENDING)
-        docs = query.stream()
-
-        logs_list = []
-        for doc in docs:
-            log_data = doc.to_dict()
-            if 'timestamp' in log_data and isinstance(log_data['timestamp'], datetime):
-                # <-- MUDANÇA 4: Converte para o fuso de SP e formata
-                log_data['timestamp'] = log_data['timestamp'].astimezone(SAO_PAULO_TZ).strftime('%d/%m/%Y %H:%M:%S')
-            logs_list.append(log_data)
-
-        if not logs_list:
-            flash("Nenhum dado encontrado para exportar.", "warning")
-            return redirect(url_for('superadmin.activity_log'))
-
-        df = pd.DataFrame(logs_list)
-        # Reordena e renomeia colunas para o Excel
-        df = df[['timestamp', 'username', 'ip_address', 'action', 'details']]
-        df.columns = ['Data/Hora', 'Usuário', 'Endereço IP', 'Ação', 'Detalhes']
-        
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Log_de_Atividades')
-        output.seek(0)
-
-        filename = f"log_atividades_{date.today().strftime('%Y-%m-%d')}.xlsx"
-        return Response(output, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        headers={"Content-Disposition": f"attachment;filename={filename}"})
+    filters = {key: request.args.get(key, '') for key in ('username', 'action', 'start_date', 'end_date', 'details')}
+    export_format = request.args.get('format', 'xlsx')
 
+    try:
+        # Os registros são lidos do Supabase em páginas e escritos na resposta aos poucos
+        rows = iter_activity_log(filters)
+        first_row = next(rows, None)
     except Exception as e:
         flash(f"Erro ao exportar dados: {e}", "danger")
         return redirect(url_for('superadmin.activity_log'))
-    
\ No newline at end of file
+
+    if first_row is None:
+        flash("Nenhum dado encontrado para exportar.", "warning")
+        return redirect(url_for('superadmin.activity_log'))
+
+    export_rows = _export_rows(first_row, rows)
+    filename = f"log_atividades_{date.today().strftime('%Y-%m-%d')}"
+
+    if export_format == 'csv':
+        return Response(stream_with_context(_stream_csv(export_rows)), mimetype="text/csv; charset=utf-8",
+                        headers={"Content-Disposition": f"attachment;filename={filename}.csv"})
+
+    return Response(stream_with_context(_stream_xlsx(export_rows)),
+                    mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    headers={"Content-Disposition": f"attachment;filename={filename}.xlsx"})
@@ -1,7 +1,8 @@
 # app/routes/user_routes.py
-from flask import Blueprint, render_template, request, flash, redirect, url_for, session
+from flask import Blueprint, render_template, request, flash, redirect, url_for, session, jsonify
 from functools import wraps
-from app.user_manager import get_user, get_all_users, save_user, delete_user_from_db
+from app.user_manager import (get_user, get_all_users, get_users_in_scope, save_user, delete_user_from_db,
+                              bulk_create_users)
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.activity_logger import log_activity
 
@@ -45,22 +46,25 @@ def _user_in_scope(target_user_data, current_user_session):
 @user_bp.route('/users')
 @login_required
 def user_panel():
-    all_users = get_all_users()
     current_user_role = session.get('role', 'user')
     current_username = session.get('username')
     
     users_to_display = {}
     
     if current_user_role == 'superadmin':
-        users_to_display = all_users
+        users_to_display = get_all_users()
     elif current_user_role == 'admin':
-        for username, data in all_users.items():
+        # Só os usuários que compartilham alguma unidade (filtrado no Supabase)
+        scoped_users = get_users_in_scope(session.get('unidades', {}).keys())
+        for username, data in scoped_users.items():
             # Mostra o próprio admin e outros usuários no seu escopo.
             if username == current_username or _user_in_scope(data, session):
                 users_to_display[username] = data
     else: # user
-        if current_username in all_users:
-            users_to_display[current_username] = all_users[current_username]
+        own_data = get_user(current_username)
+        if own_data:
+            own_data.pop('password_hash', None)
+            users_to_display[current_username] = own_data
 
             
     available_units = session.get('unidades', {})
@@ -79,7 +83,7 @@ def add_user():
     role = request.form.get('role', 'user')
     unidades_ids = request.form.getlist('unidades')
 
-    if get_user(username):
+    if get_user(username, use_cache=False):
         flash(f'Usuário "{username}" já existe!', 'danger')
         return redirect(url_for('user.user_panel'))
 
@@ -102,18 +106,89 @@ def add_user():
         "role": role, 
         "unidades": user_units
     }
-    save_user(username, new_user_data)
+    if not save_user(username, new_user_data):
+        flash(f'Erro ao criar o usuário "{username}". Tente novamente.', 'danger')
+        return redirect(url_for('user.user_panel'))
 
     log_activity("USER_CREATED", f"'{session.get('username')}' criou o usuário '{username}'.")
     flash(f'Usuário "{username}" criado com sucesso!', 'success')
     return redirect(url_for('user.user_panel'))
 
 
+@user_bp.route('/users/bulk_import', methods=['POST'])
+@login_required
+def bulk_import_users():
+    """
+    Cria vários usuários de uma vez. Corpo JSON:
+    {"users": [{"username": "...", "password": "...", "role": "user", "unidades": ["123", ...]}, ...]}
+    Valida tudo antes de gravar; usuários que já existem são ignorados (não são alterados).
+    """
+    if session.get('role') not in ['admin', 'superadmin']:
+        return jsonify({"status": "error", "message": "Você não tem permissão para adicionar usuários."}), 403
+
+    payload = request.get_json(silent=True) or {}
+    entries = payload.get('users')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({"status": "error", "message": "Envie uma lista 'users' no corpo JSON."}), 400
+
+    # Admin cria usuários e admins; só superadmin cria superadmins
+    allowed_roles = {'user', 'admin', 'superadmin'} if session.get('role') == 'superadmin' else {'user', 'admin'}
+    admin_available_units = session.get('unidades', {})
+
+    new_users, errors = {}, []
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            errors.append(f"Linha {i + 1}: formato inválido.")
+            continue
+        username = str(entry.get('username') or '').strip()
+        password = entry.get('password')
+        role = entry.get('role', 'user')
+        if not username or not password:
+            errors.append(f"Linha {i + 1}: usuário e senha são obrigatórios.")
+            continue
+        if username in new_users:
+            errors.append(f"Linha {i + 1}: usuário '{username}' repetido.")
+            continue
+        if role not in allowed_roles:
+            errors.append(f"Linha {i + 1}: perfil '{role}' não permitido.")
+            continue
+
+        unidades = entry.get('unidades', [])
+        if not isinstance(unidades, list):
+            errors.append(f"Linha {i + 1}: 'unidades' deve ser uma lista de IDs.")
+            continue
+
+        # Mesma regra do add_user: só unidades que o admin logado possui
+        user_units = {str(uid): admin_available_units[str(uid)]
+                      for uid in unidades if str(uid) in admin_available_units}
+        if not user_units:
+            errors.append(f"Linha {i + 1}: selecione pelo menos uma unidade válida para '{username}'.")
+            continue
+
+        new_users[username] = {
+            "password_hash": generate_password_hash(password),
+            "role": role,
+            "unidades": user_units
+        }
+
+    if errors:
+        return jsonify({"status": "error", "message": "Nenhum usuário foi criado.", "errors": errors}), 400
+
+    # Quem já existe é pulado pela própria função SQL (sem sobrescrever senha nem perfil)
+    result = bulk_create_users(new_users)
+    if result is None:
+        return jsonify({"status": "error", "message": "Erro ao gravar os usuários. Nenhum usuário foi criado."}), 500
+
+    created, skipped = sorted(result['created']), sorted(result['skipped'])
+    log_activity("USERS_BULK_IMPORTED", f"'{session.get('username')}' importou {len(created)} usuário(s): {', '.join(created)}.")
+    return jsonify({"status": "success", "created": created, "skipped_existing": skipped}), 201
+
+
 @user_bp.route('/users/delete/<username>', methods=['POST'])
 @login_required
 def delete_user(username):
     # ✅ Busque apenas os dados do usuário que será deletado
-    user_to_delete = get_user(username)
+    user_to_delete = get_user(username, use_cache=False)
     if not user_to_delete:
         flash('Usuário não encontrado.', 'danger')
         return redirect(url_for('user.user_panel'))
@@ -142,7 +217,7 @@ def change_password(username):
         flash('A nova senha não pode estar em branco.', 'danger')
         return redirect(url_for('user.user_panel'))
 
-    user_data = get_user(username)
+    user_data = get_user(username, use_cache=False)
     if not user_data:
         flash('Usuário não encontrado.', 'danger')
         return redirect(url_for('user.user_panel'))
@@ -161,8 +236,10 @@ def change_password(username):
         user_data['password_hash'] = hashed_password
         
         # ✅ Salve os dados atualizados do usuário com a função correta
-        save_user(username, user_data)
-        
+        if not save_user(username, user_data):
+            flash(f'Erro ao alterar a senha do usuário "{username}". Tente novamente.', 'danger')
+            return redirect(url_for('user.user_panel'))
+
         log_activity("PASSWORD_CHANGED", f"'{session.get('username')}' alterou a senha do usuário '{username}'.")
         flash(f'Senha do usuário "{username}" alterada com sucesso!', 'success')
     else:
@@ -1,5 +1,6 @@
 # app/services/amei_api.py
 import requests
+import amei_client
 
 PROFISSIONAIS_URL = 'https://amei.amorsaude.com.br/api/v1/profissionais/by-unidade'
 SLOTS_URL = 'https://amei.amorsaude.com.br/api/v1/slots/list-slots-by-professional'
@@ -8,7 +9,7 @@ APPOINTMENT_URL_TEMPLATE = 'https://amei.amorsaude.com.br/api/v1/appointments/{}
 
 def get_all_professionals(headers):
     try:
-        response = requests.get(PROFISSIONAIS_URL, headers=headers)
+        response = amei_client.get(PROFISSIONAIS_URL, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -26,7 +27,7 @@ def get_slots_for_professional(professional_id, selected_date, clinic_id, header
         'endHour': '23:59'
     }
     try:
-        response = requests.get(SLOTS_URL, headers=headers, params=params)
+        response = amei_client.get(SLOTS_URL, headers=headers, params=params)
         response.raise_for_status()
         data = response.json()
         if data and isinstance(data, list) and len(data) > 0:
@@ -41,7 +42,7 @@ def get_patient_details(patient_id, headers):
         return None
     try:
         url = PACIENTE_URL_TEMPLATE.format(patient_id)
-        response = requests.get(url, headers=headers)
+        response = amei_client.get(url, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -53,7 +54,7 @@ def get_appointment_details(appointment_id, headers):
         return None
     try:
         url = APPOINTMENT_URL_TEMPLATE.format(appointment_id)
-        response = requests.get(url, headers=headers)
+        response = amei_client.get(url, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -0,0 +1,227 @@
+# app/services/cache_jobs.py
+# Fila de jobs de atualização de cache executados em background.
+# Cada job atualiza um (unidade, dia) com refresh_day_cache. Pedidos repetidos
+# para a mesma unidade/dia enquanto o job ainda não terminou reutilizam o mesmo job.
+# O job roda no processo que o criou; o estado também é gravado na tabela 'cache_jobs'
+# do Supabase para que GET /api/cache_jobs/<id> funcione em qualquer worker do gunicorn.
+
+import os
+import threading
+import time
+import uuid
+from datetime import date, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from update_cache_script import refresh_day_cache, build_headers
+from cache_manager import supabase
+from app.services.details_cache import PREFETCH_SLOT_DETAILS, schedule_day_prefetch
+
+CACHE_JOB_WORKERS = int(os.environ.get("CACHE_JOB_WORKERS", "4"))
+FINISHED_JOB_TTL = int(os.environ.get("CACHE_JOB_TTL", "3600"))  # segundos que um job concluído continua consultável
+# Job de outro worker sem terminar há mais que isso é considerado perdido (worker reiniciado)
+# e não é reutilizado
+ACTIVE_JOB_MAX_AGE = int(os.environ.get("CACHE_JOB_ACTIVE_MAX_AGE", "600"))  # segundos
+# Intervalo mínimo entre gravações do progresso no Supabase (o estado final é sempre gravado)
+JOB_PROGRESS_SYNC_INTERVAL = float(os.environ.get("CACHE_JOB_PROGRESS_SYNC", "1.0"))
+
+_executor = ThreadPoolExecutor(max_workers=CACHE_JOB_WORKERS, thread_name_prefix="cache-job")
+_lock = threading.Lock()
+_jobs: dict[str, dict] = {}
+_active_by_key: dict[tuple, str] = {}
+_last_db_purge = 0.0
+
+
+def _to_iso(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+
+def _persist_job(job: dict):
+    """Grava o estado do job no Supabase. Falhas só são registradas: o job continua rodando."""
+    try:
+        supabase.table('cache_jobs').upsert({
+            "id": job['id'],
+            "unit_id": job['unit_id'],
+            "unit_name": job['unit_name'],
+            "target_date": job['date'],
+            "status": job['status'],
+            "progress": job['progress'],
+            "message": job['message'],
+            "requested_by": job['requested_by'],
+            "created_at": _to_iso(job['created_at']),
+            "started_at": _to_iso(job['started_at']),
+            "finished_at": _to_iso(job['finished_at']),
+        }).execute()
+    except Exception as e:
+        print(f"AVISO [CACHE JOB]: Falha ao gravar o estado do job {job['id']}: {e}")
+
+
+def _row_to_job(row: dict) -> dict:
+    job = {field: row.get(field) for field in ('id', 'unit_id', 'unit_name', 'status', 'progress', 'message',
+                                               'requested_by', 'created_at', 'started_at', 'finished_at')}
+    job['date'] = row.get('target_date')
+    return job
+
+
+def _find_active_job_in_db(unit_id: str, date_str: str) -> dict | None:
+    """Job na fila ou em execução em OUTRO worker para o mesmo (unidade, dia), se houver."""
+    try:
+        response = supabase.table('cache_jobs').select('*') \
+            .eq('unit_id', unit_id) \
+            .eq('target_date', date_str) \
+            .in_('status', ['queued', 'running']) \
+            .gte('created_at', _to_iso(time.time() - ACTIVE_JOB_MAX_AGE)) \
+            .order('created_at', desc=True) \
+            .limit(1) \
+            .execute()
+    except Exception as e:
+        print(f"AVISO [CACHE JOB]: Falha ao procurar job ativo de {unit_id}/{date_str}: {e}")
+        return None
+    rows = response.data or []
+    return _row_to_job(rows[0]) if rows else None
+
+
+def _load_job_from_db(job_id: str) -> dict | None:
+    """Job criado por outro worker (mesmo formato de get_job)."""
+    try:
+        response = supabase.table('cache_jobs').select('*').eq('id', job_id).maybe_single().execute()
+    except Exception as e:
+        print(f"AVISO [CACHE JOB]: Falha ao consultar o job {job_id}: {e}")
+        return None
+    row = response.data if response else None
+    if not row:
+        return None
+    finished_at = row.get('finished_at')
+    if finished_at and (datetime.now(timezone.utc) - datetime.fromisoformat(finished_at)).total_seconds() > FINISHED_JOB_TTL:
+        return None
+    return _row_to_job(row)
+
+
+def _purge_finished_jobs():
+    """Remove jobs concluídos há mais de FINISHED_JOB_TTL segundos (chamada com _lock adquirido)."""
+    now = time.time()
+    expired = [job_id for job_id, job in _jobs.items()
+               if job['finished_at'] and now - job['finished_at'] > FINISHED_JOB_TTL]
+    for job_id in expired:
+        del _jobs[job_id]
+
+    # Linhas de todos os workers no Supabase (no máximo uma vez a cada 10 minutos por processo)
+    global _last_db_purge
+    if now - _last_db_purge > 600:
+        _last_db_purge = now
+        try:
+            supabase.table('cache_jobs').delete().lt('finished_at', _to_iso(now - FINISHED_JOB_TTL)).execute()
+        except Exception as e:
+            print(f"AVISO [CACHE JOB]: Falha ao limpar jobs antigos: {e}")
+
+
+def _run_job(job_id: str):
+    with _lock:
+        job = _jobs[job_id]
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        snapshot = dict(job)
+    _persist_job(snapshot)
+    target_date = date.fromisoformat(job['date'])
+    last_sync = {"at": time.monotonic()}
+
+    def _on_progress(done, total):
+        with _lock:
+            job['progress'] = {"done": done, "total": total}
+            if time.monotonic() - last_sync["at"] < JOB_PROGRESS_SYNC_INTERVAL:
+                return
+            last_sync["at"] = time.monotonic()
+            snapshot = dict(job)
+        _persist_job(snapshot)
+
+    context = None
+    try:
+        # Retorna o context do dia gravado (ou None em caso de falha)
+        context = refresh_day_cache(target_date, job['unit_id'], on_progress=_on_progress,
+                                    requested_at=job['created_at'])
+        ok = context is not None
+        status = 'done' if ok else 'error'
+        message = (f"Cache para a unidade {job['unit_name']} atualizado!" if ok
+                   else f"Erro ao atualizar o cache da unidade {job['unit_name']}.")
+    except Exception as e:
+        print(f"Erro durante a atualização do cache para {job['unit_name']}: {e}")
+        status, message = 'error', f"Erro ao atualizar o cache da unidade {job['unit_name']}."
+
+    with _lock:
+        job['status'] = status
+        job['message'] = message
+        job['finished_at'] = time.time()
+        _active_by_key.pop((job['unit_id'], job['date']), None)
+        snapshot = dict(job)
+    _persist_job(snapshot)
+    print(f"[CACHE JOB] {job_id} ({job['unit_name']} {job['date']}) finalizado: {status} "
+          f"em {job['finished_at'] - job['started_at']:.1f}s.")
+
+    # Depois de o job já aparecer como concluído: pré-carrega os detalhes do popup
+    # (em executor próprio, sem segurar este worker dos jobs de cache)
+    if context and PREFETCH_SLOT_DETAILS:
+        schedule_day_prefetch(job['unit_id'], context, lambda: build_headers(job['unit_id']))
+
+
+def enqueue_day_refresh(unit_id: str, target_date: date, unit_name: str | None = None,
+                        requested_by: str | None = None) -> tuple[dict, bool]:
+    """
+    Agenda a atualização do cache de um (unidade, dia) e retorna (job, criado).
+    Se já existe um job na fila ou em execução para o mesmo par, neste ou em outro worker,
+    ele é reutilizado (criado=False).
+    """
+    unit_id = str(unit_id)
+    key = (unit_id, target_date.isoformat())
+
+    with _lock:
+        _purge_finished_jobs()
+        existing_id = _active_by_key.get(key)
+        if existing_id:
+            return dict(_jobs[existing_id]), False
+
+    # Fora do lock (consulta de rede). Dois workers ainda podem criar jobs ao mesmo tempo;
+    # nesse caso o recheck de refresh_day_cache evita a segunda busca na API.
+    other_worker_job = _find_active_job_in_db(unit_id, key[1])
+    if other_worker_job:
+        return other_worker_job, False
+
+    with _lock:
+        existing_id = _active_by_key.get(key)
+        if existing_id:
+            return dict(_jobs[existing_id]), False
+
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {
+            "id": job_id,
+            "unit_id": unit_id,
+            "unit_name": unit_name or f"ID {unit_id}",
+            "date": target_date.isoformat(),
+            "status": "queued",
+            "progress": {"done": 0, "total": 0},
+            "message": "",
+            "requested_by": requested_by,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        _active_by_key[key] = job_id
+        job = dict(_jobs[job_id])
+
+    _persist_job(job)
+    _executor.submit(_run_job, job_id)
+    return job, True
+
+
+def get_job(job_id: str) -> dict | None:
+    """
+    Retorna uma cópia do estado atual do job (ou None se não existir/expirou).
+    Jobs deste processo vêm da memória; os de outros workers, do Supabase.
+    """
+    with _lock:
+        job = _jobs.get(job_id)
+        if job:
+            job = dict(job)
+            job['progress'] = dict(job['progress'])
+    if not job:
+        return _load_job_from_db(job_id)
+    for field in ('created_at', 'started_at', 'finished_at'):
+        job[field] = _to_iso(job[field])
+    return job
@@ -0,0 +1,157 @@
+# app/services/details_cache.py
+# Cache em memória (TTL + LRU) dos detalhes de paciente e de agendamento usados no popup
+# da agenda, com busca simultânea dos dois e pré-carregamento opcional dos horários do dia.
+
+import os
+import copy
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from app.services.amei_api import get_patient_details, get_appointment_details
+
+DETAILS_CACHE_TTL = int(os.environ.get("DETAILS_CACHE_TTL", "300"))                 # segundos
+DETAILS_CACHE_MAX_ENTRIES = int(os.environ.get("DETAILS_CACHE_MAX_ENTRIES", "5000"))
+# Pré-carrega os detalhes dos horários ocupados logo depois de uma atualização de cache
+PREFETCH_SLOT_DETAILS = os.environ.get("PREFETCH_SLOT_DETAILS", "false").lower() in ("1", "true", "yes")
+PREFETCH_MAX_IN_FLIGHT = int(os.environ.get("PREFETCH_MAX_IN_FLIGHT", "4"))
+# Dias pré-carregados ao mesmo tempo / esperando na fila; além disso o pedido é descartado
+PREFETCH_MAX_DAYS = int(os.environ.get("PREFETCH_MAX_DAYS", "2"))
+PREFETCH_MAX_PENDING_DAYS = int(os.environ.get("PREFETCH_MAX_PENDING_DAYS", "8"))
+
+_FETCHERS = {
+    "patient": get_patient_details,
+    "appointment": get_appointment_details,
+}
+
+_cache: OrderedDict = OrderedDict()   # (tipo, clinic_id, id) -> (expira_em, detalhes)
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "prefetched": 0}
+
+# Usado só para buscar paciente e agendamento ao mesmo tempo em /api/slot_details
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="slot-details")
+
+# Pré-carga: executor próprio (não ocupa os workers dos jobs de cache) e limite de dias na fila
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_DAYS, thread_name_prefix="details-prefetch-day")
+_prefetch_pending = threading.BoundedSemaphore(PREFETCH_MAX_PENDING_DAYS)
+# IDs já pré-carregados (LRU). O TTL dos detalhes é menor que o intervalo das atualizações
+# em background, então sem isso cada atualização buscaria o dia inteiro de novo; assim só
+# os agendamentos novos são buscados.
+_prefetched: OrderedDict = OrderedDict()   # (tipo, clinic_id, id) -> None
+
+
+def _cache_get(key: tuple):
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del _cache[key]
+            _stats["misses"] += 1
+            return None
+        _cache.move_to_end(key)
+        _stats["hits"] += 1
+        return copy.deepcopy(entry[1])
+
+
+def _cache_put(key: tuple, details):
+    with _lock:
+        _cache[key] = (time.monotonic() + DETAILS_CACHE_TTL, copy.deepcopy(details))
+        _cache.move_to_end(key)
+        while len(_cache) > DETAILS_CACHE_MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+def _should_prefetch(kind: str, clinic_id, item_id) -> bool:
+    key = (kind, str(clinic_id), str(item_id))
+    with _lock:
+        if key in _prefetched:
+            _prefetched.move_to_end(key)
+            return False
+        entry = _cache.get(key)
+        return entry is None or entry[0] <= time.monotonic()
+
+
+def _mark_prefetched(keys: list):
+    with _lock:
+        for key in keys:
+            _prefetched[key] = None
+            _prefetched.move_to_end(key)
+        while len(_prefetched) > DETAILS_CACHE_MAX_ENTRIES:
+            _prefetched.popitem(last=False)
+
+
+def get_details_cached(kind: str, clinic_id, item_id, headers):
+    """Detalhes de 'patient' ou 'appointment' (cache por clínica + id). Erros não são guardados."""
+    if not item_id:
+        return None
+    key = (kind, str(clinic_id), str(item_id))
+    details = _cache_get(key)
+    if details is not None:
+        return details
+    details = _FETCHERS[kind](item_id, headers)
+    if details is not None:
+        _cache_put(key, details)
+    return details
+
+
+def fetch_slot_details(clinic_id, appointment_id, patient_id, headers) -> tuple:
+    """Busca (agendamento, paciente) ao mesmo tempo. Retorna None no item que não existir."""
+    appointment_future = _executor.submit(get_details_cached, "appointment", clinic_id, appointment_id, headers)
+    patient_future = _executor.submit(get_details_cached, "patient", clinic_id, patient_id, headers)
+    return appointment_future.result(), patient_future.result()
+
+
+def prefetch_day_details(clinic_id, context: dict, headers) -> int:
+    """
+    Busca os detalhes dos horários ocupados do dia que não estão no cache e que ainda não
+    foram pré-carregados antes. Roda na thread de quem chama; em background use
+    schedule_day_prefetch. Retorna quantos buscou.
+    """
+    pending = []
+    for agenda_data in (context.get('agendas') or {}).values():
+        for slot in agenda_data.get('horarios') or []:
+            for kind, field in (("appointment", "appointmentId"), ("patient", "patientId")):
+                item_id = slot.get(field)
+                if item_id and _should_prefetch(kind, clinic_id, item_id):
+                    pending.append((kind, item_id))
+    pending = list(dict.fromkeys(pending))
+    if not pending:
+        return 0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=PREFETCH_MAX_IN_FLIGHT, thread_name_prefix="details-prefetch") as pool:
+        list(pool.map(lambda item: get_details_cached(item[0], clinic_id, item[1], headers), pending))
+    _mark_prefetched([(kind, str(clinic_id), str(item_id)) for kind, item_id in pending])
+    with _lock:
+        _stats["prefetched"] += len(pending)
+    print(f"[DETAILS PREFETCH] Unidade {clinic_id}: {len(pending)} detalhes pré-carregados "
+          f"em {time.perf_counter() - start:.1f}s.")
+    return len(pending)
+
+
+def schedule_day_prefetch(clinic_id, context: dict, get_headers) -> bool:
+    """
+    Agenda prefetch_day_details no executor próprio da pré-carga. 'get_headers()' é chamado
+    já em background (o login não atrasa quem agenda). Retorna False se a fila está cheia.
+    """
+    if not _prefetch_pending.acquire(blocking=False):
+        print(f"[DETAILS PREFETCH] Fila cheia; pré-carga da unidade {clinic_id} descartada.")
+        return False
+
+    def _run():
+        try:
+            headers = get_headers()
+            if headers:
+                prefetch_day_details(clinic_id, context, headers)
+        except Exception as e:
+            print(f"[DETAILS PREFETCH] Falha no pré-carregamento de detalhes da unidade {clinic_id}: {e}")
+        finally:
+            _prefetch_pending.release()
+
+    _prefetch_executor.submit(_run)
+    return True
+
+
+def get_details_cache_stats() -> dict:
+    with _lock:
+        return {**_stats, "entries": len(_cache)}
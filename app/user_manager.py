@@ -1,4 +1,7 @@
 import os
+import copy
+import threading
+import time
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
@@ -11,9 +14,92 @@ url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 supabase: Client = create_client(url, key)
 
+# --- Cache de usuários ---
+# Leituras do painel de usuários (get_user(), get_all_users() e get_users_in_scope())
+# são guardadas por USER_CACHE_TTL segundos; save_user(), bulk_create_users() e
+# delete_user_from_db() invalidam o cache na hora. OUTROS workers do gunicorn não recebem
+# a invalidação, então o cache nunca guarda o 'password_hash' e o login e as gravações
+# (criar, apagar, trocar senha) leem direto do Supabase com get_user(..., use_cache=False).
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "30"))  # segundos
+
+_user_cache: dict[str, tuple[float, dict]] = {}
+# Listagens: ('all',) ou ('scope', ids das unidades em ordem) -> (expira_em, {username: dados})
+_user_list_cache: dict[tuple, tuple[float, dict]] = {}
+_user_cache_lock = threading.Lock()
+
+
+def invalidate_user_cache(username: str | None = None):
+    """
+    Remove um usuário do cache (ou todos, se username for None).
+    As listagens são sempre descartadas: qualquer alteração pode mudar qualquer uma delas.
+    """
+    with _user_cache_lock:
+        if username is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(username, None)
+        _user_list_cache.clear()
+
+
+def _cached_user_list(cache_key: tuple, loader) -> dict:
+    """Lê uma listagem do cache ou chama 'loader()' (que retorna None em caso de erro, não guardado)."""
+    now = time.monotonic()
+    with _user_cache_lock:
+        cached = _user_list_cache.get(cache_key)
+        if cached and cached[0] > now:
+            return copy.deepcopy(cached[1])
+
+    users = loader()
+    if users is None:
+        return {}
+    with _user_cache_lock:
+        _user_list_cache[cache_key] = (now + USER_CACHE_TTL, copy.deepcopy(users))
+    return users
+
+
+def _format_unidades(user_data: dict) -> dict:
+    """Troca a lista de relações 'user_unidades' pelo mapa {id: nome} em 'unidades'."""
+    unidades_map = {}
+
+    # Pega a lista de relações e a remove do dict principal
+    relations_list = user_data.pop('user_unidades', [])
+
+    for rel in relations_list:
+        unidade = rel.get('unidades')
+        if unidade:
+            unidades_map[str(unidade['id'])] = unidade['nome']
+
+    # Adiciona o mapa 'unidades' reformatado
+    user_data['unidades'] = unidades_map
+    return user_data
+
 # --- Funções ---
 
-def get_user(username: str) -> dict | None:
+def get_user(username: str, use_cache: bool = True) -> dict | None:
+    """
+    Busca um único usuário, juntando suas unidades.
+    Com use_cache=True (padrão) usa o cache de curta duração e NÃO retorna o 'password_hash'.
+    Use use_cache=False para autenticar ou antes de gravar: lê do Supabase, com o hash.
+    """
+    now = time.monotonic()
+    if use_cache:
+        with _user_cache_lock:
+            cached = _user_cache.get(username)
+            if cached and cached[0] > now:
+                # Cópia: quem chama pode alterar o dict
+                return copy.deepcopy(cached[1])
+
+    user_data = _fetch_user(username)
+    if user_data is None:
+        invalidate_user_cache(username)
+        return None
+
+    cached_data = {field: value for field, value in user_data.items() if field != 'password_hash'}
+    with _user_cache_lock:
+        _user_cache[username] = (now + USER_CACHE_TTL, copy.deepcopy(cached_data))
+    return user_data if not use_cache else cached_data
+
+def _fetch_user(username: str) -> dict | None:
     """Busca um único usuário no Supabase, juntando suas unidades."""
     try:
         # 1. Fazemos a consulta "JOIN"
@@ -37,98 +123,135 @@ def get_user(username: str) -> dict | None:
             return None
 
         # 3. Reformatamos os dados para parecer com o Firestore (isto estava correto)
-        unidades_map = {}
-        
-        # Pega a lista de relações e a remove do dict principal
-        relations_list = user_data.pop('user_unidades', []) 
-        
-        for rel in relations_list:
-            unidade = rel.get('unidades')
-            if unidade:
-                unidades_map[str(unidade['id'])] = unidade['nome']
-        
-        # Adiciona o mapa 'unidades' reformatado
-        user_data['unidades'] = unidades_map
-        return user_data
+        return _format_unidades(user_data)
 
     except Exception as e:
         print(f"ERRO ao buscar usuário '{username}': {e}")
         return None
 
+# Colunas para listagens (painel de usuários): sem 'password_hash', que a tela não usa
+_USER_LIST_SELECT = '''
+    username,
+    role,
+    user_unidades!inner (
+        unidades (id, nome)
+    )
+'''
+
+def _users_to_dict(rows: list) -> dict:
+    users_dict = {}
+    # Loop para reformatar CADA usuário
+    for user_data in rows or []:
+        username = user_data.pop('username') # Pega o username para ser a chave
+        users_dict[username] = _format_unidades(user_data) # Monta o dict final
+    return users_dict
+
 def get_all_users() -> dict:
-    """Busca todos os usuários do Supabase."""
+    """Busca todos os usuários do Supabase (sem o hash da senha). Usa o cache de curta duração."""
+    return _cached_user_list(('all',), _fetch_all_users)
+
+def _fetch_all_users() -> dict | None:
     try:
         # 1. Mesma consulta do get_user(), mas sem o filtro '.eq()'
+        response = supabase.table('users').select(_USER_LIST_SELECT).execute()
+        return _users_to_dict(response.data)
+        
+    except Exception as e:
+        print(f"ERRO ao buscar todos os usuários: {e}")
+        return None
+
+def get_users_in_scope(unit_ids) -> dict:
+    """
+    Busca só os usuários que têm pelo menos uma das unidades informadas (escopo de um admin),
+    filtrando no Supabase em vez de carregar a base inteira. Superadmins ficam de fora.
+    Usa o cache de curta duração, por conjunto de unidades.
+    """
+    unit_ids = sorted({int(uid) for uid in unit_ids})
+    if not unit_ids:
+        return {}
+    return _cached_user_list(('scope', tuple(unit_ids)), lambda: _fetch_users_in_scope(unit_ids))
+
+def _fetch_users_in_scope(unit_ids: list) -> dict | None:
+    try:
+        # 1. Quem compartilha alguma unidade
+        rel_response = supabase.table('user_unidades') \
+            .select('username') \
+            .in_('unidade_id', unit_ids) \
+            .execute()
+        usernames = sorted({rel['username'] for rel in rel_response.data or []})
+        if not usernames:
+            return {}
+
+        # 2. Os dados desses usuários (com TODAS as unidades de cada um)
         response = supabase.table('users') \
-            .select('''
-                username, 
-                role, 
-                password_hash,
-                user_unidades!inner (
-                    unidades (id, nome)
-                )
-            ''') \
+            .select(_USER_LIST_SELECT) \
+            .in_('username', usernames) \
+            .neq('role', 'superadmin') \
             .execute()
+        return _users_to_dict(response.data)
 
-        users_dict = {}
-        if not response.data:
-            return {}
+    except Exception as e:
+        print(f"ERRO ao buscar usuários do escopo {unit_ids}: {e}")
+        return None
 
-        # 2. Loop para reformatar CADA usuário
-        for user_data in response.data:
-            username = user_data.pop('username') # Pega o username para ser a chave
-            
-            unidades_map = {}
-            relations_list = user_data.pop('user_unidades', [])
-            
-            for rel in relations_list:
-                unidade = rel.get('unidades')
-                if unidade:
-                    unidades_map[str(unidade['id'])] = unidade['nome']
-            
-            user_data['unidades'] = unidades_map
-            users_dict[username] = user_data # Monta o dict final
-        
-        return users_dict
-        
+def get_all_unidades() -> dict:
+    """Busca todas as unidades cadastradas no Supabase, no formato {id: nome}."""
+    try:
+        response = supabase.table('unidades').select('id, nome').order('nome').execute()
+        return {str(u['id']): u['nome'] for u in (response.data or [])}
     except Exception as e:
-        print(f"ERRO ao buscar todos os usuários: {e}")
+        print(f"ERRO ao buscar unidades: {e}")
         return {}
 
-def save_user(username: str, user_data: dict):
-    """Cria ou atualiza um usuário no Supabase (modo "transação")."""
+def _rpc_user_params(username: str, user_data: dict) -> dict:
+    """Parâmetros das funções SQL save_user_with_units/bulk_create_users (ver supabase/migrations)."""
+    return {
+        "username": username,
+        "role": user_data.get('role'),
+        "password_hash": user_data.get('password_hash'),
+        "unidades": {str(uid): nome for uid, nome in (user_data.get('unidades') or {}).items()},
+    }
+
+def save_user(username: str, user_data: dict) -> bool:
+    """
+    Cria ou atualiza um usuário no Supabase em UMA transação (RPC 'save_user_with_units'):
+    grava os dados do usuário e aplica só as diferenças nas relações com as unidades.
+    """
     try:
-        # Copiamos para não modificar o dicionário original
-        data_copy = user_data.copy()
-        
-        # 1. Separamos o mapa 'unidades' do resto dos dados
-        unidades_map = data_copy.pop('unidades', {})
-        
-        # 2. Inserimos/Atualizamos os dados simples na tabela 'users'
-        data_copy['username'] = username # Adiciona a PK
-        supabase.table('users').upsert(data_copy).execute()
-
-        # 3. Garantimos que todas as unidades existem na tabela 'unidades'
-        if unidades_map:
-            unidades_list = [
-                {"id": int(uid), "nome": nome} 
-                for uid, nome in unidades_map.items()
-            ]
-            supabase.table('unidades').upsert(unidades_list).execute()
-
-        # 4. Deletamos TODAS as relações antigas (para simular o .set() do Firestore)
-        supabase.table('user_unidades').delete().eq('username', username).execute()
-
-        # 5. Inserimos as novas relações
-        if unidades_map:
-            relations_list = [
-                {"username": username, "unidade_id": int(uid)} 
-                for uid in unidades_map.keys()
-            ]
-            supabase.table('user_unidades').insert(relations_list).execute()
+        params = _rpc_user_params(username, user_data)
+        supabase.rpc('save_user_with_units', {
+            "p_username": params["username"],
+            "p_role": params["role"],
+            "p_password_hash": params["password_hash"],
+            "p_unidades": params["unidades"],
+        }).execute()
+        return True
 
     except Exception as e:
         print(f"ERRO ao salvar usuário '{username}': {e}")
+        return False
+    finally:
+        invalidate_user_cache(username)
+
+def bulk_create_users(users: dict) -> dict | None:
+    """
+    Cria vários usuários ({username: user_data}) em uma única chamada e transação
+    (RPC 'bulk_create_users'). Usuários que já existem são pulados, sem nenhuma alteração.
+    Retorna {"created": [...], "skipped": [...]}, ou None em caso de erro (nada é gravado).
+    """
+    if not users:
+        return {"created": [], "skipped": []}
+    try:
+        payload = [_rpc_user_params(username, data) for username, data in users.items()]
+        response = supabase.rpc('bulk_create_users', {"p_users": payload}).execute()
+        return {"created": response.data.get('created') or [], "skipped": response.data.get('skipped') or []}
+
+    except Exception as e:
+        print(f"ERRO ao importar {len(users)} usuários: {e}")
+        return None
+    finally:
+        for username in users:
+            invalidate_user_cache(username)
 
 def delete_user_from_db(username: str):
     """Deleta um usuário do Supabase."""
@@ -139,4 +262,6 @@ def delete_user_from_db(username: str):
         supabase.table('users').delete().eq('username', username).execute()
         
     except Exception as e:
-        print(f"ERRO ao deletar usuário '{username}': {e}")
\ No newline at end of file
+        print(f"ERRO ao deletar usuário '{username}': {e}")
+    finally:
+        invalidate_user_cache(username)
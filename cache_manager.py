@@ -2,9 +2,16 @@
 
 import os
 import json
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datetime import date
 from supabase import create_client, Client
 from dotenv import load_dotenv
+import local_cache
+from metrics import COUNT_COLUMNS, professional_counts
 
 # --- INICIALIZAÇÃO DO CLIENTE SUPABASE ---
 load_dotenv()
@@ -12,13 +19,179 @@ url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 supabase: Client = create_client(url, key)
 
+# Quantidade máxima de linhas de detalhes por upsert na gravação em lote
+DETAILS_BATCH_SIZE = 500
+
+# --- CACHE EM MEMÓRIA (LRU + TTL) ---
+# Fica na frente do Supabase para que visualizações repetidas do mesmo dia/unidade
+# (outros usuários, troca de unidade com switch_unit) não façam novas consultas.
+MEMORY_CACHE_TTL = int(os.environ.get("CACHE_MEMORY_TTL", "60"))              # segundos
+MEMORY_CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MEMORY_MAX_ENTRIES", "256"))
+
+_memory_cache: OrderedDict = OrderedDict()   # (unit_id, 'YYYY-MM-DD') -> (expira_em, context)
+_memory_lock = threading.Lock()
+_memory_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+
+def _memory_get(key: tuple) -> dict | None:
+    with _memory_lock:
+        entry = _memory_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            _memory_cache.move_to_end(key)
+            _memory_stats["hits"] += 1
+            # Cópia profunda: as rotas alteram o context (ex.: 'percent_numeric' nos rankings)
+            return copy.deepcopy(entry[1])
+        if entry:
+            del _memory_cache[key]
+        _memory_stats["misses"] += 1
+        return None
+
+
+def _memory_version(key: tuple) -> str | None:
+    """'last_updated_iso' da entrada em memória (sem copiar o context), ou None."""
+    with _memory_lock:
+        entry = _memory_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1].get('last_updated_iso')
+        return None
+
+
+def _memory_put(key: tuple, context: dict):
+    with _memory_lock:
+        _memory_cache[key] = (time.monotonic() + MEMORY_CACHE_TTL, copy.deepcopy(context))
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > MEMORY_CACHE_MAX_ENTRIES:
+            _memory_cache.popitem(last=False)
+            _memory_stats["evictions"] += 1
+
+
+def invalidate_memory_cache(unit_id: str, target_date: date | None = None):
+    """Remove do cache em memória um dia (ou todos os dias, se 'target_date' for None) de uma unidade."""
+    unit_id_int = int(unit_id)
+    date_str = target_date.strftime('%Y-%m-%d') if target_date else None
+    with _memory_lock:
+        keys = [k for k in _memory_cache if k[0] == unit_id_int and (date_str is None or k[1] == date_str)]
+        for k in keys:
+            del _memory_cache[k]
+        _memory_stats["invalidations"] += len(keys)
+
+
+def get_memory_cache_stats() -> dict:
+    """Retorna os contadores do cache em memória (hits, misses, evictions, invalidations, entries)."""
+    with _memory_lock:
+        return {**_memory_stats, "entries": len(_memory_cache)}
+
+
+# --- AVISO DE GRAVAÇÃO (usado por /api/cache_events) ---
+# Cada gravação de um (unidade, dia) neste processo incrementa um contador e acorda quem
+# está esperando por ele, para que o evento saia na hora em vez de no próximo polling.
+_write_condition = threading.Condition()
+_write_versions: dict[tuple, int] = {}
+
+
+def _notify_cache_written(unit_id_int: int, date_str: str):
+    with _write_condition:
+        key = (unit_id_int, date_str)
+        _write_versions[key] = _write_versions.get(key, 0) + 1
+        _write_condition.notify_all()
+
+
+def wait_for_cache_write(unit_id: str, target_date: date, last_seen: int | None, timeout: float) -> int:
+    """
+    Espera até 'timeout' segundos por uma gravação do (unidade, dia) neste processo.
+    Retorna o contador atual; passe-o como 'last_seen' na próxima chamada.
+    """
+    key = (int(unit_id), target_date.strftime('%Y-%m-%d'))
+    with _write_condition:
+        _write_condition.wait_for(lambda: _write_versions.get(key, 0) != last_seen, timeout)
+        return _write_versions.get(key, 0)
+
+
+def peek_cache_version(unit_id: str, target_date: date) -> str | None:
+    """
+    'last_updated_iso' do dia segundo o cache em memória ou o disco local (se conferido há
+    menos de LOCAL_CACHE_REVALIDATE segundos), sem ir ao Supabase. None = não se sabe;
+    use load_cache_version.
+    """
+    unit_id_int = int(unit_id)
+    date_str = target_date.strftime('%Y-%m-%d')
+    version = _memory_version((unit_id_int, date_str))
+    if version:
+        return version
+    local_entry = local_cache.get_version(unit_id_int, date_str)
+    if local_entry and local_entry[0] and local_entry[1] < local_cache.LOCAL_CACHE_REVALIDATE:
+        return local_entry[0]
+    return None
+
+
+def load_cache_version(unit_id: str, target_date: date) -> dict | None:
+    """
+    Versão da entrada de cache no Supabase, sem carregar os dados:
+    {"last_updated_iso": ..., "schedule_hashes": {professional_id: hash} ou None}.
+    Retorna None se o dia não está em cache ou se a consulta falhar.
+    """
+    try:
+        response = supabase.table('agendas_cache_summary') \
+            .select('last_updated_iso:summary_data->>last_updated_iso, schedule_hashes:summary_data->schedule_hashes') \
+            .eq('unit_id', int(unit_id)) \
+            .eq('target_date', target_date.strftime('%Y-%m-%d')) \
+            .maybe_single() \
+            .execute()
+        if not response or not response.data:
+            return None
+        return {"last_updated_iso": response.data.get('last_updated_iso'),
+                "schedule_hashes": response.data.get('schedule_hashes')}
+    except Exception as e:
+        print(f"AVISO: Falha ao consultar a versão do cache {unit_id}/{target_date}: {e}")
+        return None
+
+
 # --- FUNÇÕES DO CACHE ---
 
+# --- FORMATO COMPACTO DOS HORÁRIOS (agendas_cache_details.schedule_data) ---
+# Em vez dos dicts completos que vêm da API da AMEI, guardamos só os campos usados pelo
+# index.html e pelas contagens, em colunas (uma lista por campo, na ordem dos horários):
+#   {"v": 1, "id": ..., "nome": ..., "n": 3, "slots": {"formatedHour": [...], "status": [...], ...}}
+# Campos ausentes em todos os horários não são gravados. Entradas antigas (sem "v") são lidas
+# como estão. Mudou o formato? Incremente SLOT_FORMAT_VERSION e trate a versão anterior no decoder.
+SLOT_FORMAT_VERSION = 1
+SLOT_FIELDS = ('formatedHour', 'numeric_hour', 'status', 'appointmentStatus',
+               'patient', 'patientId', 'appointmentId')
+
+
+def encode_schedule(prof_data: dict) -> dict:
+    """Converte {'id', 'nome', 'horarios': [slot, ...]} para o formato compacto em colunas."""
+    horarios = prof_data.get('horarios') or []
+    columns = {}
+    for field in SLOT_FIELDS:
+        if any(field in slot for slot in horarios):
+            columns[field] = [slot.get(field) for slot in horarios]
+    return {
+        "v": SLOT_FORMAT_VERSION,
+        "id": prof_data.get('id'),
+        "nome": prof_data.get('nome'),
+        "n": len(horarios),
+        "slots": columns,
+    }
+
+
+def decode_schedule(schedule_data: dict) -> dict:
+    """Remonta {'id', 'nome', 'horarios': [slot, ...]} a partir do schedule_data gravado."""
+    if not schedule_data or 'v' not in schedule_data:
+        return schedule_data  # formato antigo: dicts completos da API
+    columns = schedule_data.get('slots') or {}
+    # Valores nulos ficam de fora do slot (o template trata chave ausente como vazio)
+    horarios = [{field: values[i] for field, values in columns.items() if values[i] is not None}
+                for i in range(schedule_data.get('n', 0))]
+    return {"id": schedule_data.get('id'), "nome": schedule_data.get('nome'), "horarios": horarios}
+
+
 def save_agendas_to_cache_v2(context: dict, target_date: date, unit_id: str):
     """Salva os dados de agenda e métricas nas tabelas do Supabase."""
     try:
         unit_id_int = int(unit_id)
         date_str = target_date.strftime('%Y-%m-%d')
+        invalidate_memory_cache(unit_id, target_date)
         
         # 1. Separa os dados das agendas do contexto principal
         agendas_data = context.pop("agendas", {})
@@ -43,12 +216,22 @@ def save_agendas_to_cache_v2(context: dict, target_date: date, unit_id: str):
                         "target_date": date_str,
                         "professional_id": prof_id,
                         "professional_name": prof_nome,
-                        "schedule_data": prof_data # O dict inteiro do profissional vai para o JSONB
+                        "schedule_data": encode_schedule(prof_data) # Formato compacto (ver encode_schedule)
                     })
             
             if details_payload:
                 supabase.table('agendas_cache_details').upsert(details_payload).execute()
 
+        # 4. Contagens numéricas por profissional (falha aqui não invalida o cache já gravado)
+        try:
+            _write_daily_metrics(unit_id_int, {date_str: context.get("resumo_geral") or {}})
+        except Exception as e:
+            print(f"AVISO: Falha ao gravar agendas_daily_metrics de {date_str} (unidade: {unit_id}): {e}")
+
+        # Invalida de novo: uma leitura concorrente pode ter recarregado a versão antiga durante a gravação
+        invalidate_memory_cache(unit_id, target_date)
+        local_cache.delete_entry(unit_id_int, date_str)
+        _notify_cache_written(unit_id_int, date_str)
         print(f"Cache para {date_str} (unidade: {unit_id}) salvo com sucesso no Supabase.")
 
     except Exception as e:
@@ -56,12 +239,68 @@ def save_agendas_to_cache_v2(context: dict, target_date: date, unit_id: str):
         # Adiciona os dados de volta ao context em caso de falha
         context['agendas'] = agendas_data
 
-def load_agendas_from_cache_v2(target_date: date, unit_id: str) -> dict | None:
-    """Carrega os dados de agenda e métricas do cache do Supabase."""
+def _load_from_local_cache(unit_id_int: int, date_str: str) -> dict | None:
+    """
+    Devolve o context do cache local se ele ainda vale. Entradas conferidas há menos de
+    LOCAL_CACHE_REVALIDATE segundos são servidas direto; as demais são comparadas com o
+    'last_updated_iso' do Supabase. Se o Supabase estiver fora do ar, serve a cópia local.
+    Retorna None quando é preciso carregar do Supabase.
+    """
+    entry = local_cache.get_entry(unit_id_int, date_str)
+    if entry is None:
+        return None
+    context, local_version, checked_ago = entry
+
+    if checked_ago < local_cache.LOCAL_CACHE_REVALIDATE:
+        print(f"Cache para {date_str} (unidade: {unit_id_int}) servido do disco local.")
+        return context
+
+    try:
+        response = supabase.table('agendas_cache_summary') \
+            .select('last_updated_iso:summary_data->>last_updated_iso') \
+            .eq('unit_id', unit_id_int) \
+            .eq('target_date', date_str) \
+            .maybe_single() \
+            .execute()
+    except Exception as e:
+        print(f"AVISO: Supabase indisponível ({e}). Servindo {date_str} (unidade: {unit_id_int}) do disco local.")
+        return context
+
+    if not response or not response.data:
+        # Apagado no Supabase: a cópia local também não vale mais
+        local_cache.delete_entry(unit_id_int, date_str)
+        return None
+    if response.data.get('last_updated_iso') != local_version:
+        return None
+
+    local_cache.touch_entry(unit_id_int, date_str)
+    print(f"Cache para {date_str} (unidade: {unit_id_int}) conferido e servido do disco local.")
+    return context
+
+def load_agendas_from_cache_v2(target_date: date, unit_id: str, expected_version: str | None = None) -> dict | None:
+    """
+    Carrega os dados de agenda e métricas do cache do Supabase.
+    Com 'expected_version' (um last_updated_iso), as cópias em memória/disco local com outra
+    versão são ignoradas e o dia é lido de novo do Supabase.
+    """
     try:
         unit_id_int = int(unit_id)
         date_str = target_date.strftime('%Y-%m-%d')
 
+        def _is_expected(ctx):
+            return expected_version is None or ctx.get('last_updated_iso') == expected_version
+
+        cached = _memory_get((unit_id_int, date_str))
+        if cached is not None and _is_expected(cached):
+            print(f"Cache para {date_str} (unidade: {unit_id}) servido da memória.")
+            return cached
+
+        # Cache local em disco (opcional, compartilhado entre os workers)
+        local_context = _load_from_local_cache(unit_id_int, date_str)
+        if local_context is not None and _is_expected(local_context):
+            _memory_put((unit_id_int, date_str), local_context)
+            return local_context
+
         # 1. Carrega o resumo da tabela principal
         summary_response = supabase.table('agendas_cache_summary') \
             .select('summary_data') \
@@ -89,8 +328,10 @@ def load_agendas_from_cache_v2(target_date: date, unit_id: str) -> dict | None:
         if details_response.data:
             for item in details_response.data:
                 prof_nome = item['professional_name']
-                context['agendas'][prof_nome] = item['schedule_data']
+                context['agendas'][prof_nome] = decode_schedule(item['schedule_data'])
 
+        _memory_put((unit_id_int, date_str), context)
+        local_cache.put_entry(unit_id_int, date_str, context)
         print(f"Cache para {date_str} (unidade: {unit_id}) carregado com sucesso do Supabase.")
         return context
 
@@ -98,6 +339,103 @@ def load_agendas_from_cache_v2(target_date: date, unit_id: str) -> dict | None:
         print(f"Erro CRÍTICO ao carregar cache do Supabase. Erro: {e}")
         return None
 
+# Linhas por página nas leituras em lote (o PostgREST limita o tamanho de cada resposta)
+SUMMARY_PAGE_SIZE = 1000
+
+def load_daily_metrics(unit_ids: list, start_date: date, end_date: date) -> list:
+    """
+    Lê as linhas de agendas_daily_metrics de várias unidades em um período (contagens
+    numéricas por unidade/dia/profissional, sem JSON), paginando poucas consultas.
+    """
+    if not unit_ids:
+        return []
+    try:
+        start_str, end_str = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+        rows, offset = [], 0
+        while True:
+            response = supabase.table('agendas_daily_metrics') \
+                .select('unit_id, target_date, professional_name, total, occupied, confirmed, attended, no_show') \
+                .in_('unit_id', [int(uid) for uid in unit_ids]) \
+                .gte('target_date', start_str) \
+                .lte('target_date', end_str) \
+                .order('target_date') \
+                .order('unit_id') \
+                .order('professional_name') \
+                .range(offset, offset + SUMMARY_PAGE_SIZE - 1) \
+                .execute()
+            page = response.data or []
+            rows.extend(page)
+            if len(page) < SUMMARY_PAGE_SIZE:
+                break
+            offset += SUMMARY_PAGE_SIZE
+
+        print(f"Métricas de {start_str} a {end_str} ({len(unit_ids)} unidades): {len(rows)} linhas carregadas.")
+        return rows
+
+    except Exception as e:
+        print(f"Erro CRÍTICO ao carregar métricas diárias do Supabase. Erro: {e}")
+        return []
+
+def load_unit_metrics_totals(unit_ids: list, start_date: date, end_date: date) -> dict:
+    """
+    Totais por unidade em um período, somados no banco (RPC 'daily_metrics_by_unit').
+    Retorna {unit_id (str): {"days", "total", "occupied", "confirmed", "attended", "no_show"}};
+    unidades sem nenhum dia em cache ficam de fora.
+    """
+    if not unit_ids:
+        return {}
+    try:
+        response = supabase.rpc('daily_metrics_by_unit', {
+            "p_unit_ids": [int(uid) for uid in unit_ids],
+            "p_start": start_date.strftime('%Y-%m-%d'),
+            "p_end": end_date.strftime('%Y-%m-%d'),
+        }).execute()
+        return {
+            str(row['unit_id']): {col: int(row.get(col) or 0) for col in ("days",) + tuple(COUNT_COLUMNS)}
+            for row in response.data or []
+        }
+    except Exception as e:
+        print(f"Erro CRÍTICO ao carregar totais por unidade do Supabase. Erro: {e}")
+        return {}
+
+def _write_daily_metrics(unit_id_int: int, resumos_by_date_str: dict):
+    """
+    Atualiza agendas_daily_metrics para os dias informados ({'YYYY-MM-DD': resumo_geral}):
+    upsert das contagens atuais e remoção dos profissionais que não aparecem mais.
+    Chamada depois de o resumo do dia existir (chave estrangeira).
+    """
+    if not resumos_by_date_str:
+        return
+    dates = sorted(resumos_by_date_str.keys())
+    rows, current = [], {}
+    for date_str in dates:
+        counts = professional_counts(resumos_by_date_str[date_str])
+        current[date_str] = set(counts.keys())
+        for prof_nome, prof_counts in counts.items():
+            rows.append({"unit_id": unit_id_int, "target_date": date_str, "professional_name": prof_nome, **prof_counts})
+
+    existing = supabase.table('agendas_daily_metrics') \
+        .select('target_date, professional_name') \
+        .eq('unit_id', unit_id_int) \
+        .gte('target_date', dates[0]) \
+        .lte('target_date', dates[-1]) \
+        .execute()
+    gone_by_date = {}
+    for row in existing.data or []:
+        date_str = row['target_date']
+        if date_str in current and row['professional_name'] not in current[date_str]:
+            gone_by_date.setdefault(date_str, []).append(row['professional_name'])
+
+    for i in range(0, len(rows), DETAILS_BATCH_SIZE):
+        supabase.table('agendas_daily_metrics').upsert(rows[i:i + DETAILS_BATCH_SIZE]).execute()
+    for date_str, gone in gone_by_date.items():
+        supabase.table('agendas_daily_metrics') \
+            .delete() \
+            .eq('unit_id', unit_id_int) \
+            .eq('target_date', date_str) \
+            .in_('professional_name', gone) \
+            .execute()
+
 def delete_day_from_cache_v2(target_date: date, unit_id: str):
     """
     Deleta o cache de um dia. MUITO MAIS SIMPLES com SQL!
@@ -105,6 +443,7 @@ def delete_day_from_cache_v2(target_date: date, unit_id: str):
     try:
         unit_id_int = int(unit_id)
         date_str = target_date.strftime('%Y-%m-%d')
+        invalidate_memory_cache(unit_id, target_date)
 
         # Graças ao "ON DELETE CASCADE" que definimos no SQL,
         # basta deletar o registro da tabela de resumo.
@@ -114,8 +453,200 @@ def delete_day_from_cache_v2(target_date: date, unit_id: str):
             .eq('unit_id', unit_id_int) \
             .eq('target_date', date_str) \
             .execute()
+        local_cache.delete_entry(unit_id_int, date_str)
         
         print(f"Cache para {date_str} (unidade: {unit_id}) deletado com sucesso do Supabase.")
 
     except Exception as e:
-        print(f"Erro CRÍTICO ao deletar cache do Supabase para o dia {date_str}. Erro: {e}")
\ No newline at end of file
+        print(f"Erro CRÍTICO ao deletar cache do Supabase para o dia {date_str}. Erro: {e}")
+
+# --- GRAVAÇÃO INCREMENTAL (DELTA) ---
+# Cada profissional tem um hash do seu schedule_data (compacto) guardado em summary_data['schedule_hashes'].
+# Na atualização, só os profissionais cujo hash mudou são regravados, os que sumiram são
+# removidos e o resumo é atualizado por último (upsert de uma linha, atômico). O dia nunca
+# fica vazio para quem está lendo, ao contrário do antigo delete + save.
+
+def _schedule_hash(prof_data: dict) -> str:
+    """Hash estável do schedule_data (já no formato compacto) de um profissional."""
+    payload = json.dumps(prof_data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _load_existing_hashes(unit_id_int: int, start_str: str, end_str: str) -> dict:
+    """
+    Retorna {date_str: hashes} para os dias do período que já existem no cache.
+    'hashes' é None quando a entrada foi gravada antes do modo delta (sem hashes).
+    """
+    response = supabase.table('agendas_cache_summary') \
+        .select('target_date, schedule_hashes:summary_data->schedule_hashes') \
+        .eq('unit_id', unit_id_int) \
+        .gte('target_date', start_str) \
+        .lte('target_date', end_str) \
+        .execute()
+    return {row['target_date']: row.get('schedule_hashes') for row in response.data or []}
+
+
+def _load_existing_professional_ids(unit_id_int: int, date_str: str) -> set:
+    response = supabase.table('agendas_cache_details') \
+        .select('professional_id') \
+        .eq('unit_id', unit_id_int) \
+        .eq('target_date', date_str) \
+        .execute()
+    return {str(row['professional_id']) for row in response.data or []}
+
+
+def _write_days_delta(unit_id_int: int, contexts_by_date_str: dict) -> dict:
+    """
+    Grava vários dias de uma unidade em modo delta e retorna contadores da operação.
+    'contexts_by_date_str' é {'YYYY-MM-DD': context}; os contexts do chamador não são alterados.
+    """
+    dates = sorted(contexts_by_date_str.keys())
+    existing = _load_existing_hashes(unit_id_int, dates[0], dates[-1])
+
+    new_summaries, existing_summaries, details_payload = [], [], []
+    stored_contexts = {}
+    gone_by_date = {}
+    unchanged = 0
+
+    for date_str in dates:
+        summary_data = dict(contexts_by_date_str[date_str])
+        agendas_data = summary_data.pop("agendas", {})
+
+        old_hashes = existing.get(date_str)
+        if date_str in existing and old_hashes is None:
+            # Entrada antiga, sem hashes: regrava tudo e descobre quem saiu pelos IDs gravados
+            old_ids = _load_existing_professional_ids(unit_id_int, date_str)
+            old_hashes = {}
+        else:
+            old_hashes = old_hashes or {}
+            old_ids = set(old_hashes.keys())
+
+        new_hashes = {}
+        stored_agendas = {}
+        for prof_nome, prof_data in agendas_data.items():
+            prof_id = prof_data.get("id")
+            if not prof_id:
+                continue
+            schedule_data = encode_schedule(prof_data)
+            stored_agendas[prof_nome] = decode_schedule(schedule_data)
+            prof_hash = _schedule_hash(schedule_data)
+            new_hashes[str(prof_id)] = prof_hash
+            if old_hashes.get(str(prof_id)) == prof_hash:
+                unchanged += 1
+                continue
+            details_payload.append({
+                "unit_id": unit_id_int,
+                "target_date": date_str,
+                "professional_id": prof_id,
+                "professional_name": prof_nome,
+                "schedule_data": schedule_data
+            })
+
+        gone = old_ids - set(new_hashes.keys())
+        if gone:
+            gone_by_date[date_str] = gone
+
+        summary_data["schedule_hashes"] = new_hashes
+        # O que uma leitura do Supabase devolveria depois desta gravação (para o cache local)
+        stored_contexts[date_str] = {**summary_data, "agendas": stored_agendas}
+        payload = {"unit_id": unit_id_int, "target_date": date_str, "summary_data": summary_data}
+        (existing_summaries if date_str in existing else new_summaries).append(payload)
+
+    # 1. Dias novos: o resumo precisa existir antes dos detalhes (chave estrangeira)
+    if new_summaries:
+        supabase.table('agendas_cache_summary').upsert(new_summaries).execute()
+
+    # 2. Só os profissionais que mudaram
+    for i in range(0, len(details_payload), DETAILS_BATCH_SIZE):
+        supabase.table('agendas_cache_details').upsert(details_payload[i:i + DETAILS_BATCH_SIZE]).execute()
+
+    # 3. Só os profissionais que não aparecem mais
+    for date_str, gone in gone_by_date.items():
+        supabase.table('agendas_cache_details') \
+            .delete() \
+            .eq('unit_id', unit_id_int) \
+            .eq('target_date', date_str) \
+            .in_('professional_id', [int(pid) if pid.isdigit() else pid for pid in gone]) \
+            .execute()
+
+    # 4. Dias já existentes: o resumo é atualizado por último
+    if existing_summaries:
+        supabase.table('agendas_cache_summary').upsert(existing_summaries).execute()
+
+    # 5. Contagens numéricas por profissional (agendas_daily_metrics).
+    # O cache já está gravado: uma falha aqui só é registrada, não falha a gravação.
+    try:
+        _write_daily_metrics(unit_id_int, {
+            date_str: contexts_by_date_str[date_str].get("resumo_geral") or {} for date_str in dates
+        })
+    except Exception as e:
+        print(f"AVISO: Falha ao gravar agendas_daily_metrics de {dates[0]} a {dates[-1]} (unidade: {unit_id_int}): {e}")
+
+    return {
+        "days": len(dates),
+        "upserted": len(details_payload),
+        "unchanged": unchanged,
+        "deleted": sum(len(g) for g in gone_by_date.values()),
+        "contexts": stored_contexts,
+    }
+
+
+def save_agendas_delta_v2(context: dict, target_date: date, unit_id: str) -> bool:
+    """
+    Atualiza o cache de um dia em modo delta (ver _write_days_delta).
+    Diferente de save_agendas_to_cache_v2, NÃO remove 'agendas' do context recebido.
+    Retorna True se a gravação foi concluída.
+    """
+    try:
+        unit_id_int = int(unit_id)
+        date_str = target_date.strftime('%Y-%m-%d')
+        invalidate_memory_cache(unit_id, target_date)
+
+        stats = _write_days_delta(unit_id_int, {date_str: context})
+
+        invalidate_memory_cache(unit_id, target_date)
+        local_cache.put_entry(unit_id_int, date_str, stats["contexts"][date_str])
+        _notify_cache_written(unit_id_int, date_str)
+        print(f"Cache para {date_str} (unidade: {unit_id}) atualizado no Supabase: "
+              f"{stats['upserted']} agendas gravadas, {stats['unchanged']} sem mudança, {stats['deleted']} removidas.")
+        return True
+
+    except Exception as e:
+        print(f"Erro CRÍTICO ao salvar cache (delta) no Supabase. Erro: {e}")
+        return False
+
+
+def save_period_to_cache_v2(contexts_by_date: dict, unit_id: str) -> bool:
+    """
+    Salva vários dias de uma unidade de uma só vez, em modo delta:
+    uma consulta dos hashes do período, upserts em lote só do que mudou e os resumos no final.
+    'contexts_by_date' é um dict {date: context} no mesmo formato de save_agendas_to_cache_v2.
+    """
+    if not contexts_by_date:
+        return True
+
+    try:
+        unit_id_int = int(unit_id)
+        dates = sorted(contexts_by_date.keys())
+        for target_date in dates:
+            invalidate_memory_cache(unit_id, target_date)
+
+        stats = _write_days_delta(
+            unit_id_int,
+            {d.strftime('%Y-%m-%d'): contexts_by_date[d] for d in dates}
+        )
+
+        for target_date in dates:
+            invalidate_memory_cache(unit_id, target_date)
+        for date_str, stored_context in stats["contexts"].items():
+            local_cache.put_entry(unit_id_int, date_str, stored_context)
+            _notify_cache_written(unit_id_int, date_str)
+
+        print(f"Cache de {dates[0]} a {dates[-1]} (unidade: {unit_id}) salvo em lote no Supabase: "
+              f"{stats['days']} dias, {stats['upserted']} agendas gravadas, "
+              f"{stats['unchanged']} sem mudança, {stats['deleted']} removidas.")
+        return True
+
+    except Exception as e:
+        print(f"Erro CRÍTICO ao salvar cache do período no Supabase. Erro: {e}")
+        return False
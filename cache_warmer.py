@@ -0,0 +1,148 @@
+# cache_warmer.py
+# Aquece o cache de TODAS as unidades cadastradas na tabela 'unidades'.
+# Cada (unidade, dia) vira um job; os jobs de hoje e amanhã são executados
+# primeiro e cada unidade tem um limite próprio de jobs simultâneos.
+#
+# Uso:
+#   python cache_warmer.py                      # uma rodada: hoje + 15 dias, todas as unidades
+#   python cache_warmer.py --days 7 --units 932 933
+#   python cache_warmer.py --loop --interval 30 # modo daemon, uma rodada a cada 30 minutos
+
+import argparse
+import sys
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+# Adiciona o caminho do diretório atual ao sys.path para que imports funcionem
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from dotenv import load_dotenv
+from update_cache_script import process_and_cache_day
+from app.user_manager import get_all_unidades
+
+load_dotenv()
+
+DEFAULT_DAYS_AHEAD = int(os.environ.get("WARMER_DAYS_AHEAD", "15"))
+DEFAULT_MAX_WORKERS = int(os.environ.get("WARMER_MAX_WORKERS", "6"))
+DEFAULT_PER_UNIT_LIMIT = int(os.environ.get("WARMER_PER_UNIT_LIMIT", "2"))
+
+
+def build_jobs(unidades: dict, start_date: date, days_ahead: int) -> list:
+    """
+    Monta a lista de jobs (unidade, dia) já na ordem de prioridade:
+    primeiro o dia mais próximo (hoje, amanhã, ...), depois o nome da unidade.
+    """
+    jobs = []
+    for offset in range(days_ahead + 1):
+        target_date = start_date + timedelta(days=offset)
+        for unit_id, unit_name in sorted(unidades.items(), key=lambda item: item[1]):
+            jobs.append({"unit_id": unit_id, "unit_name": unit_name, "date": target_date, "priority": offset})
+    return jobs
+
+
+def run_warm_cycle(unidades: dict, days_ahead: int = DEFAULT_DAYS_AHEAD,
+                   max_workers: int = DEFAULT_MAX_WORKERS, per_unit_limit: int = DEFAULT_PER_UNIT_LIMIT) -> list:
+    """
+    Executa uma rodada completa de aquecimento e retorna a lista de resultados
+    ({unit_id, unit_name, date, ok, duration, error}) de cada job.
+    """
+    pending = build_jobs(unidades, date.today(), days_ahead)
+    total_jobs = len(pending)
+    running_per_unit = {}
+    results = []
+    condition = threading.Condition()
+
+    print(f"[WARMER] Iniciando rodada: {len(unidades)} unidades, {total_jobs} jobs, "
+          f"{max_workers} workers, até {per_unit_limit} jobs simultâneos por unidade.")
+    cycle_start = time.perf_counter()
+
+    def _next_job():
+        # Pega o job de maior prioridade cuja unidade ainda tem vaga
+        for job in pending:
+            if running_per_unit.get(job["unit_id"], 0) < per_unit_limit:
+                return job
+        return None
+
+    def _worker():
+        while True:
+            with condition:
+                while True:
+                    if not pending:
+                        return
+                    job = _next_job()
+                    if job:
+                        pending.remove(job)
+                        running_per_unit[job["unit_id"]] = running_per_unit.get(job["unit_id"], 0) + 1
+                        break
+                    condition.wait()
+
+            start = time.perf_counter()
+            error = None
+            try:
+                ok = process_and_cache_day(job["date"], job["unit_id"])
+            except Exception as e:
+                ok, error = False, str(e)
+            duration = time.perf_counter() - start
+
+            with condition:
+                running_per_unit[job["unit_id"]] -= 1
+                results.append({
+                    "unit_id": job["unit_id"], "unit_name": job["unit_name"], "date": job["date"],
+                    "ok": ok, "duration": duration, "error": error
+                })
+                print(f"[WARMER] ({len(results)}/{total_jobs}) {job['unit_name']} {job['date']} -> "
+                      f"{'OK' if ok else 'FALHA'} em {duration:.1f}s")
+                condition.notify_all()
+
+    threads = [threading.Thread(target=_worker, daemon=True) for _ in range(max(1, max_workers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    _print_cycle_report(results, time.perf_counter() - cycle_start)
+    return results
+
+
+def _print_cycle_report(results: list, elapsed: float):
+    failures = [r for r in results if not r["ok"]]
+    durations = sorted((r["duration"] for r in results), reverse=True)
+    print("=" * 60)
+    print(f"[WARMER] Rodada finalizada em {elapsed:.1f}s: {len(results) - len(failures)} OK, {len(failures)} falhas.")
+    if durations:
+        print(f"[WARMER] Duração por job: média {sum(durations) / len(durations):.1f}s | mais lento {durations[0]:.1f}s")
+    for r in failures:
+        print(f"[WARMER] FALHA: {r['unit_name']} (ID {r['unit_id']}) em {r['date']}" + (f": {r['error']}" if r["error"] else ""))
+    print("=" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aquece o cache de agendas de todas as unidades.")
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS_AHEAD, help="Quantidade de dias à frente (além de hoje).")
+    parser.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS, help="Jobs simultâneos no total.")
+    parser.add_argument('--per-unit', type=int, default=DEFAULT_PER_UNIT_LIMIT, help="Jobs simultâneos por unidade.")
+    parser.add_argument('--units', nargs='*', help="IDs das unidades (padrão: todas da tabela 'unidades').")
+    parser.add_argument('--loop', action='store_true', help="Executa continuamente (modo daemon).")
+    parser.add_argument('--interval', type=int, default=30, help="Minutos entre rodadas no modo --loop.")
+    args = parser.parse_args()
+
+    while True:
+        unidades = get_all_unidades()
+        if args.units:
+            unidades = {uid: nome for uid, nome in unidades.items() if uid in set(args.units)}
+
+        if not unidades:
+            print("[WARMER] Nenhuma unidade encontrada para aquecer.")
+        else:
+            run_warm_cycle(unidades, args.days, args.workers, args.per_unit)
+
+        if not args.loop:
+            break
+        print(f"[WARMER] Próxima rodada em {args.interval} minutos.")
+        time.sleep(args.interval * 60)
+
+
+if __name__ == '__main__':
+    main()
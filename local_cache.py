@@ -0,0 +1,120 @@
+# local_cache.py
+# Camada de cache local em disco (SQLite em modo WAL) na frente do Supabase.
+# Opcional: só é usada quando a variável LOCAL_CACHE_DB aponta para um arquivo.
+# O arquivo é compartilhado pelos workers do gunicorn da mesma máquina, então um dia
+# carregado por um worker é servido do disco pelos outros, e leituras repetidas continuam
+# funcionando durante quedas curtas do Supabase.
+
+import os
+import json
+import sqlite3
+import threading
+import time
+
+LOCAL_CACHE_DB = os.environ.get("LOCAL_CACHE_DB", "")
+# Entradas locais mais novas que isso são servidas sem consultar o Supabase;
+# depois disso, compara-se o 'last_updated_iso' com o do Supabase (consulta leve).
+LOCAL_CACHE_REVALIDATE = float(os.environ.get("LOCAL_CACHE_REVALIDATE", "60"))  # segundos
+
+_local = threading.local()
+
+
+def is_enabled() -> bool:
+    return bool(LOCAL_CACHE_DB)
+
+
+def _connection() -> sqlite3.Connection:
+    """Uma conexão por thread (e por processo: recriada após o fork do gunicorn)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "pid", None) == os.getpid():
+        return conn
+
+    conn = sqlite3.connect(LOCAL_CACHE_DB, timeout=5, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            unit_id          INTEGER NOT NULL,
+            target_date      TEXT    NOT NULL,
+            last_updated_iso TEXT,
+            context          TEXT    NOT NULL,
+            checked_at       REAL    NOT NULL,
+            PRIMARY KEY (unit_id, target_date)
+        )
+    """)
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def get_entry(unit_id: int, date_str: str) -> tuple[dict, str | None, float] | None:
+    """Retorna (context, last_updated_iso, segundos desde a última conferência) ou None."""
+    if not is_enabled():
+        return None
+    try:
+        row = _connection().execute(
+            "SELECT context, last_updated_iso, checked_at FROM cache_entries WHERE unit_id = ? AND target_date = ?",
+            (unit_id, date_str)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], max(0.0, time.time() - row[2])
+    except Exception as e:
+        print(f"AVISO [CACHE LOCAL]: Falha ao ler {unit_id}/{date_str}: {e}")
+        return None
+
+
+def get_version(unit_id: int, date_str: str) -> tuple[str | None, float] | None:
+    """Só (last_updated_iso, segundos desde a última conferência), sem ler o context."""
+    if not is_enabled():
+        return None
+    try:
+        row = _connection().execute(
+            "SELECT last_updated_iso, checked_at FROM cache_entries WHERE unit_id = ? AND target_date = ?",
+            (unit_id, date_str)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], max(0.0, time.time() - row[1])
+    except Exception as e:
+        print(f"AVISO [CACHE LOCAL]: Falha ao ler a versão de {unit_id}/{date_str}: {e}")
+        return None
+
+
+def put_entry(unit_id: int, date_str: str, context: dict):
+    if not is_enabled():
+        return
+    try:
+        _connection().execute(
+            "INSERT OR REPLACE INTO cache_entries (unit_id, target_date, last_updated_iso, context, checked_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (unit_id, date_str, context.get('last_updated_iso'),
+             json.dumps(context, ensure_ascii=False, default=str), time.time())
+        )
+    except Exception as e:
+        print(f"AVISO [CACHE LOCAL]: Falha ao gravar {unit_id}/{date_str}: {e}")
+
+
+def touch_entry(unit_id: int, date_str: str):
+    """Marca a entrada como conferida agora (o Supabase tem a mesma versão)."""
+    if not is_enabled():
+        return
+    try:
+        _connection().execute(
+            "UPDATE cache_entries SET checked_at = ? WHERE unit_id = ? AND target_date = ?",
+            (time.time(), unit_id, date_str)
+        )
+    except Exception as e:
+        print(f"AVISO [CACHE LOCAL]: Falha ao atualizar {unit_id}/{date_str}: {e}")
+
+
+def delete_entry(unit_id: int, date_str: str):
+    if not is_enabled():
+        return
+    try:
+        _connection().execute(
+            "DELETE FROM cache_entries WHERE unit_id = ? AND target_date = ?", (unit_id, date_str)
+        )
+    except Exception as e:
+        print(f"AVISO [CACHE LOCAL]: Falha ao remover {unit_id}/{date_str}: {e}")
@@ -3,6 +3,10 @@
 import requests
 import json
 import os
+import base64
+import threading
+import time
+import amei_client
 
 # 1. Definições da Requisição
 LOGIN_URL = 'https://amei.amorsaude.com.br/api/v1/security/login'
@@ -38,37 +42,75 @@ LOGIN_PAYLOAD = {
     'keepConnected': True
 }
 
-def get_auth_new(clinic_id):
-    # Crie a URL dinamicamente
-    refresh_url = f'https://amei.amorsaude.com.br/api/v1/security/refresh-token?clinicId={clinic_id}'
+# --- Cache de tokens ---
+# O token preliminar (passo 1) é o mesmo para todas as clínicas e o token final
+# (passo 2) é por clínica. Ambos são reutilizados até pouco antes de expirarem.
+TOKEN_EXPIRY_MARGIN = int(os.environ.get("AMEI_TOKEN_EXPIRY_MARGIN", "60"))      # segundos antes do 'exp' em que o token deixa de ser usado
+TOKEN_REFRESH_AHEAD = int(os.environ.get("AMEI_TOKEN_REFRESH_AHEAD", "300"))     # segundos antes do 'exp' em que o refresh em background começa
+TOKEN_DEFAULT_TTL = int(os.environ.get("AMEI_TOKEN_DEFAULT_TTL", "1800"))        # usado quando o JWT não traz 'exp'
+
+_token_lock = threading.Lock()
+_preliminary_token: dict | None = None          # {"token": str, "exp": float}
+_clinic_tokens: dict[str, dict] = {}            # clinic_id -> {"token": str, "exp": float}
+_clinic_locks: dict[str, threading.Lock] = {}
+_refreshing: set[str] = set()
+_token_owner: dict[str, tuple[str, float]] = {}  # token final -> (clinic_id, exp), para tratar 401
+
+
+def _decode_jwt_exp(token: str) -> float:
+    """Lê o campo 'exp' do payload do JWT (sem validar a assinatura)."""
+    try:
+        payload_b64 = token.split('.')[1]
+        payload_b64 += '=' * (-len(payload_b64) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(payload_b64))
+        return float(payload['exp'])
+    except (IndexError, KeyError, ValueError, TypeError):
+        return time.time() + TOKEN_DEFAULT_TTL
 
-    # 2. Início do Teste
-    print("="*60)
-    print("INICIANDO AUTENTICAÇÃO EM 2 PASSOS")
-    print("="*60)
 
-    # --- PASSO 1: Login Inicial ---
+def _is_valid(entry: dict | None, margin: int = TOKEN_EXPIRY_MARGIN) -> bool:
+    return bool(entry) and entry['exp'] - margin > time.time()
+
+
+def _get_clinic_lock(clinic_key: str) -> threading.Lock:
+    with _token_lock:
+        return _clinic_locks.setdefault(clinic_key, threading.Lock())
+
+
+def _login_preliminary(force: bool = False) -> str | None:
+    """PASSO 1: Login inicial. O token é compartilhado entre todas as clínicas."""
+    global _preliminary_token
+    with _token_lock:
+        if not force and _is_valid(_preliminary_token):
+            return _preliminary_token['token']
+
     try:
-        login_response = requests.post(LOGIN_URL, json=LOGIN_PAYLOAD)
+        login_response = amei_client.post(LOGIN_URL, json=LOGIN_PAYLOAD)
         login_response.raise_for_status()
         preliminary_token = login_response.json().get('access_token')
 
         if not preliminary_token:
             print("\n❌ FALHA NO PASSO 1: Token preliminar não foi encontrado.")
-            exit()
+            return None
 
         print("\n✅ SUCESSO NO PASSO 1!")
 
     except requests.exceptions.RequestException as e:
         print(f"\n❌ FALHA NO PASSO 1: Erro na requisição de login. Detalhes: {e}")
-        exit()
+        return None
+
+    with _token_lock:
+        _preliminary_token = {"token": preliminary_token, "exp": _decode_jwt_exp(preliminary_token)}
+    return preliminary_token
+
 
-    # --- PASSO 2: Refresh com o método POST ---
+def _refresh_for_clinic(clinic_id, preliminary_token: str) -> str | None:
+    """PASSO 2: Troca o token preliminar pelo token da clínica (método POST)."""
+    refresh_url = f'https://amei.amorsaude.com.br/api/v1/security/refresh-token?clinicId={clinic_id}'
     preliminary_headers = {'Authorization': f"Bearer {preliminary_token}"}
 
     try:
-        # --- MUDANÇA PRINCIPAL AQUI: de requests.get para requests.post ---
-        refresh_response = requests.post(refresh_url, headers=preliminary_headers)
+        refresh_response = amei_client.post(refresh_url, headers=preliminary_headers)
         refresh_response.raise_for_status()
 
         refresh_data = refresh_response.json()
@@ -76,17 +118,114 @@ def get_auth_new(clinic_id):
 
         if not final_token:
             print("\n❌ FALHA NO PASSO 2: Token final não encontrado na resposta.")
-            exit()
+            return None
 
         print("\n✅ SUCESSO NO PASSO 2! Autenticação completa.")
         return final_token
-            
-        
 
     except requests.exceptions.RequestException as e:
         print(f"\n❌ FALHA NO PASSO 2: Erro na requisição de refresh.")
         print(f"Detalhes: {e}")
         if 'refresh_response' in locals():
             print(f"Resposta do Servidor: {refresh_response.text}")
+        return None
+
+
+def _authenticate(clinic_id) -> str | None:
+    """Executa o fluxo de 2 passos e guarda o token final no cache."""
+    print("="*60)
+    print(f"INICIANDO AUTENTICAÇÃO EM 2 PASSOS (clínica {clinic_id})")
+    print("="*60)
+
+    preliminary_token = _login_preliminary()
+    if not preliminary_token:
+        return None
+
+    final_token = _refresh_for_clinic(clinic_id, preliminary_token)
+    if not final_token:
+        # O token preliminar em cache pode ter sido revogado: tenta uma vez com um novo login
+        preliminary_token = _login_preliminary(force=True)
+        if not preliminary_token:
+            return None
+        final_token = _refresh_for_clinic(clinic_id, preliminary_token)
+        if not final_token:
+            return None
+
+    exp = _decode_jwt_exp(final_token)
+    with _token_lock:
+        _clinic_tokens[str(clinic_id)] = {"token": final_token, "exp": exp}
+        now = time.time()
+        for token in [t for t, (_, token_exp) in _token_owner.items() if token_exp < now]:
+            del _token_owner[token]
+        _token_owner[final_token] = (str(clinic_id), exp)
+    return final_token
 
 
+def _background_refresh(clinic_id):
+    clinic_key = str(clinic_id)
+    try:
+        with _get_clinic_lock(clinic_key):
+            _authenticate(clinic_id)
+    finally:
+        with _token_lock:
+            _refreshing.discard(clinic_key)
+
+
+def invalidate_auth(clinic_id=None):
+    """Descarta o token de uma clínica (ou todos, se nenhuma for informada)."""
+    global _preliminary_token
+    with _token_lock:
+        if clinic_id is None:
+            _clinic_tokens.clear()
+            _preliminary_token = None
+        else:
+            _clinic_tokens.pop(str(clinic_id), None)
+
+
+def renew_rejected_token(token: str) -> str | None:
+    """
+    Chamada pelo amei_client quando a API responde 401 para 'token'.
+    Descarta o token da clínica dona dele (invalidate_auth) e devolve um novo, com login do zero.
+    Se outra thread já renovou o token dessa clínica, devolve o atual sem novo login.
+    Retorna None se o token não é de nenhuma clínica conhecida ou se a autenticação falhar.
+    """
+    with _token_lock:
+        owner = _token_owner.get(token)
+        if not owner:
+            return None
+        clinic_key = owner[0]
+        entry = _clinic_tokens.get(clinic_key)
+        if entry and entry['token'] != token and _is_valid(entry):
+            return entry['token']
+
+    print(f"AVISO [AUTH]: Token da clínica {clinic_key} recusado pela API (401). Autenticando de novo.")
+    invalidate_auth(clinic_key)
+    return get_auth_new(clinic_key)
+
+
+amei_client.set_unauthorized_handler(renew_rejected_token)
+
+
+def get_auth_new(clinic_id):
+    """
+    Retorna um token válido para a clínica, reutilizando o cache sempre que possível.
+    Perto do vencimento, devolve o token atual e renova em background.
+    Retorna None se a autenticação falhar.
+    """
+    clinic_key = str(clinic_id)
+
+    with _token_lock:
+        entry = _clinic_tokens.get(clinic_key)
+        if _is_valid(entry):
+            if not _is_valid(entry, TOKEN_REFRESH_AHEAD) and clinic_key not in _refreshing:
+                _refreshing.add(clinic_key)
+                threading.Thread(target=_background_refresh, args=(clinic_id,), daemon=True).start()
+            return entry['token']
+
+    # Sem token válido: só uma thread por clínica autentica, as outras esperam e reutilizam
+    with _get_clinic_lock(clinic_key):
+        with _token_lock:
+            entry = _clinic_tokens.get(clinic_key)
+            if _is_valid(entry):
+                return entry['token']
+        return _authenticate(clinic_id)
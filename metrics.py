@@ -1,157 +1,262 @@
 # app/metrics.py
 
+import numpy as np
 import pandas as pd
 
-def calculate_summary_metrics(resumo_geral, df_resumo):
-    """Calcula as métricas de resumo para os cards principais."""
-    
-    df = df_resumo
-    
-    # Inicializa contadores
-    total_horarios_disponiveis = 0
-    total_horarios_ocupados = 0
-    total_horarios_confirmados = 0
-    
-    # Percorre cada profissional (linha do DataFrame)
-    for profissional, row in df.iterrows():
-        profissional_total = 0
-        profissional_ocupados = 0
-        profissional_confirmados = 0
-        
-        # Percorre cada coluna (status) do profissional
-        for status, quantidade in row.items():
-            # Total de horários disponíveis é a soma de TODOS os status
-            profissional_total += quantidade
-            
-            # Verifica se é um horário ocupado (não é Livre nem Bloqueado)
-            if status not in ['Livre', 'Bloqueado']:
-                profissional_ocupados += quantidade
-                
-                # Verifica se é confirmado
-                if 'confirmado' in status.lower():
-                    profissional_confirmados += quantidade
-        
-        # Adiciona ao total geral (inclui profissionais com apenas "Livre")
-        total_horarios_disponiveis += profissional_total
-        total_horarios_ocupados += profissional_ocupados
-        total_horarios_confirmados += profissional_confirmados
-    
-    # Calcula as porcentagens
-    taxa_ocupacao = (total_horarios_ocupados / total_horarios_disponiveis * 100) if total_horarios_disponiveis > 0 else 0
-    taxa_confirmacao = (total_horarios_confirmados / total_horarios_ocupados * 100) if total_horarios_ocupados > 0 else 0
-    
+# Status que NÃO contam como horário ocupado
+STATUS_NAO_OCUPADOS = ['Livre', 'Bloqueado']
+# Trechos de status que representam pacientes que foram atendidos
+STATUS_ATENDIDOS = ['atendido', 'atendimento concluído', 'finalizado', 'aguardando pós-consulta']
+# Status que representa falta do paciente (mesma coluna usada no dashboard superadmin)
+STATUS_FALTOU = 'Não compareceu'
+
+
+def classify_status_columns(columns) -> dict:
+    """
+    Classifica as colunas de status UMA vez em máscaras booleanas:
+    - occupied: não é Livre nem Bloqueado
+    - confirmed: ocupado e contém 'confirmado'
+    - attended: contém algum dos trechos de STATUS_ATENDIDOS
+    - no_show: é exatamente STATUS_FALTOU
+    """
+    status = pd.Index(columns).astype(str)
+    lower = status.str.lower()
+
+    occupied = ~status.isin(STATUS_NAO_OCUPADOS)
+    confirmed = occupied & lower.str.contains('confirmado', regex=False)
+    attended = np.zeros(len(status), dtype=bool)
+    for trecho in STATUS_ATENDIDOS:
+        attended |= lower.str.contains(trecho, regex=False)
+    no_show = status == STATUS_FALTOU
+
     return {
-        "total_agendado_geral": int(total_horarios_ocupados),
-        "total_confirmado_geral": int(total_horarios_confirmados),
+        "occupied": np.asarray(occupied, dtype=bool),
+        "confirmed": np.asarray(confirmed, dtype=bool),
+        "attended": np.asarray(attended, dtype=bool),
+        "no_show": np.asarray(no_show, dtype=bool),
+    }
+
+
+def _rate(numerador, denominador):
+    """Taxa percentual elemento a elemento; 0 quando o denominador é 0."""
+    numerador = np.asarray(numerador, dtype=float)
+    denominador = np.asarray(denominador, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominador > 0, numerador / denominador * 100, 0.0)
+
+
+def _ranking(profissionais, taxas, key_name, totals: dict):
+    """Monta a lista de um ranking no formato usado pelos templates, ordenada pela taxa."""
+    stats = []
+    for i, prof in enumerate(profissionais):
+        item = {"profissional": prof, key_name: f"{taxas[i]:.2f}%"}
+        for total_name, values in totals.items():
+            item[total_name] = int(values[i])
+        # Mesmo valor que a barra de progresso usa (taxa arredondada para 2 casas)
+        item["percent_numeric"] = float(item[key_name][:-1])
+        stats.append(item)
+    return sorted(stats, key=lambda x: float(x[key_name][:-1]), reverse=True)
+
+
+def calculate_all_metrics(df_resumo) -> dict:
+    """
+    Calcula TODAS as métricas (cards de resumo, conversão global e os três rankings)
+    em uma única passada vetorizada sobre o DataFrame (linhas = profissionais, colunas = status).
+    Além dos textos formatados, devolve as taxas numéricas ('*_numeric' e 'percent_numeric').
+    """
+    masks = classify_status_columns(df_resumo.columns)
+    values = df_resumo.to_numpy(dtype=np.int64) if df_resumo.size else np.zeros((len(df_resumo.index), 0), dtype=np.int64)
+
+    total_prof = values.sum(axis=1)
+    ocupados_prof = values[:, masks["occupied"]].sum(axis=1)
+    confirmados_prof = values[:, masks["confirmed"]].sum(axis=1)
+    atendidos_prof = values[:, masks["attended"]].sum(axis=1)
+
+    total_geral = int(total_prof.sum())
+    ocupados_geral = int(ocupados_prof.sum())
+    confirmados_geral = int(confirmados_prof.sum())
+    atendidos_geral = int(atendidos_prof.sum())
+
+    taxa_ocupacao = (ocupados_geral / total_geral * 100) if total_geral > 0 else 0
+    taxa_confirmacao = (confirmados_geral / ocupados_geral * 100) if ocupados_geral > 0 else 0
+    taxa_conversao = (atendidos_geral / ocupados_geral * 100) if ocupados_geral > 0 else 0
+
+    summary_metrics = {
+        "total_agendado_geral": ocupados_geral,
+        "total_confirmado_geral": confirmados_geral,
         "percentual_confirmacao": f"{taxa_confirmacao:.2f}%",
-        "total_ocupados": int(total_horarios_ocupados),
-        "total_slots_disponiveis": int(total_horarios_disponiveis),
-        "percentual_ocupacao": f"{taxa_ocupacao:.2f}%"
+        "total_ocupados": ocupados_geral,
+        "total_slots_disponiveis": total_geral,
+        "percentual_ocupacao": f"{taxa_ocupacao:.2f}%",
+        "percentual_confirmacao_numeric": round(taxa_confirmacao, 2),
+        "percentual_ocupacao_numeric": round(taxa_ocupacao, 2),
+    }
+
+    if df_resumo.empty:
+        conversion = {"conversion_rate": "0.00%", "total_atendidos": 0, "conversion_rate_numeric": 0.0}
+    else:
+        conversion = {
+            "conversion_rate": f"{taxa_conversao:.2f}%",
+            "total_atendidos": atendidos_geral,
+            "conversion_rate_numeric": round(taxa_conversao, 2),
+        }
+
+    profissionais = list(df_resumo.index)
+    return {
+        "summary_metrics": summary_metrics,
+        "conversion_data_for_selected_day": conversion,
+        "profissionais_stats_confirmacao": _ranking(
+            profissionais, _rate(confirmados_prof, ocupados_prof), "taxa_confirmacao",
+            {"total_ocupados": ocupados_prof, "total_confirmados": confirmados_prof}),
+        "profissionais_stats_ocupacao": _ranking(
+            profissionais, _rate(ocupados_prof, total_prof), "taxa_ocupacao",
+            {"total_slots": total_prof, "total_ocupados": ocupados_prof}),
+        "profissionais_stats_conversao": _ranking(
+            profissionais, _rate(atendidos_prof, ocupados_prof), "taxa_conversao",
+            {"total_agendamentos": ocupados_prof, "total_atendidos": atendidos_prof}),
     }
 
+
+def _without_numeric(item: dict) -> dict:
+    return {k: v for k, v in item.items() if k != "percent_numeric" and not k.endswith("_numeric")}
+
+
+# --- Funções individuais (mantidas por compatibilidade; usam o cálculo vetorizado) ---
+
+def calculate_summary_metrics(resumo_geral, df_resumo):
+    """Calcula as métricas de resumo para os cards principais."""
+    return _without_numeric(calculate_all_metrics(df_resumo)["summary_metrics"])
+
 def calculate_confirmation_ranking(df):
     """Calcula o ranking de taxa de confirmação por profissional."""
-    stats = []
-    
-    for prof, row in df.iterrows():
-        total_ocupados_prof = 0
-        total_confirmados_prof = 0
-        
-        for status, quantidade in row.items():
-            # Horários ocupados do profissional
-            if status not in ['Livre', 'Bloqueado']:
-                total_ocupados_prof += quantidade
-                
-                # Horários confirmados do profissional
-                if 'confirmado' in status.lower():
-                    total_confirmados_prof += quantidade
-        
-        # Inclui TODOS os profissionais, mesmo os que só têm "Livre" (total_ocupados_prof = 0)
-        taxa = (total_confirmados_prof / total_ocupados_prof * 100) if total_ocupados_prof > 0 else 0
-        stats.append({
-            "profissional": prof,
-            "taxa_confirmacao": f"{taxa:.2f}%",
-            "total_ocupados": int(total_ocupados_prof),
-            "total_confirmados": int(total_confirmados_prof)
-        })
-    
-    return sorted(stats, key=lambda x: float(x['taxa_confirmacao'][:-1]), reverse=True)
+    return [_without_numeric(s) for s in calculate_all_metrics(df)["profissionais_stats_confirmacao"]]
 
 def calculate_occupation_ranking(df):
     """Calcula o ranking de taxa de ocupação por profissional."""
-    stats = []
-
-    for prof, row in df.iterrows():
-        total_slots_prof = row.sum()
-        total_ocupados_prof = 0
-        
-        for status, quantidade in row.items():
-            if status not in ['Livre', 'Bloqueado']:
-                total_ocupados_prof += quantidade
-        
-        # Inclui TODOS os profissionais, mesmo os que só têm "Livre"
-        taxa = (total_ocupados_prof / total_slots_prof * 100) if total_slots_prof > 0 else 0
-        stats.append({
-            "profissional": prof,
-            "taxa_ocupacao": f"{taxa:.2f}%",
-            "total_slots": int(total_slots_prof),
-            "total_ocupados": int(total_ocupados_prof)
-        })
-        
-    return sorted(stats, key=lambda x: float(x['taxa_ocupacao'][:-1]), reverse=True)
+    return [_without_numeric(s) for s in calculate_all_metrics(df)["profissionais_stats_ocupacao"]]
 
 def calculate_conversion_ranking(df):
     """Calcula o ranking de taxa de conversão (comparecimento) por profissional."""
-    stats = []
-    
-    for prof, row in df.iterrows():
-        # Atendidos: status que representam pacientes que foram atendidos
-        atendidos = 0
-        status_atendidos = ['atendido', 'atendimento concluído', 'finalizado', 'aguardando pós-consulta']
-        for status, quantidade in row.items():
-            if any(s in status.lower() for s in status_atendidos):
-                atendidos += quantidade
-        
-        # Total de agendamentos válidos (ocupados)
-        total_agendamentos = 0
-        for status, quantidade in row.items():
-            if status not in ['Livre', 'Bloqueado']:
-                total_agendamentos += quantidade
-        
-        # Inclui TODOS os profissionais, mesmo os que só têm "Livre"
-        taxa = (atendidos / total_agendamentos * 100) if total_agendamentos > 0 else 0
-        stats.append({
-            "profissional": prof,
-            "taxa_conversao": f"{taxa:.2f}%",
-            "total_agendamentos": int(total_agendamentos),
-            "total_atendidos": int(atendidos)
-        })
-    
-    return sorted(stats, key=lambda x: float(x['taxa_conversao'][:-1]), reverse=True)
+    return [_without_numeric(s) for s in calculate_all_metrics(df)["profissionais_stats_conversao"]]
 
 def calculate_global_conversion_rate(df):
     """Calcula a taxa de conversão geral para o card de resumo."""
-    if df.empty:
-        return {"conversion_rate": "0.00%", "total_atendidos": 0}
-
-    total_atendidos = 0
-    total_agendamentos = 0
-    
-    status_atendidos = ['atendido', 'atendimento concluído', 'finalizado', 'aguardando pós-consulta']
-    
-    for _, row in df.iterrows():
-        for status, quantidade in row.items():
-            # Total de agendamentos (exclui Livre e Bloqueado)
-            if status not in ['Livre', 'Bloqueado']:
-                total_agendamentos += quantidade
-            
-            # Total de atendidos
-            if any(s in status.lower() for s in status_atendidos):
-                total_atendidos += quantidade
-    
-    taxa = (total_atendidos / total_agendamentos * 100) if total_agendamentos > 0 else 0
-    
+    return _without_numeric(calculate_all_metrics(df)["conversion_data_for_selected_day"])
+
+
+# --- View model persistido no cache ---
+# Incrementar sempre que a lógica de métricas ou o formato do view model mudar:
+# entradas de cache com versão menor são recalculadas na leitura.
+METRICS_VERSION = 2
+
+def build_view_model(resumo_geral: dict) -> dict:
+    """
+    Monta tudo o que o index.html precisa a partir do 'resumo_geral':
+    cards, rankings (já com 'percent_numeric') e a tabela de resumo (headers/index/body).
+    O resultado é salvo junto com o cache para que a leitura seja só carregar e renderizar.
+    """
+    view_model = {"metrics_version": METRICS_VERSION}
+    if not resumo_geral:
+        return view_model
+
+    df_resumo = pd.DataFrame.from_dict(resumo_geral, orient='index').fillna(0).astype(int)
+    view_model.update(calculate_all_metrics(df_resumo))
+
+    if not df_resumo.empty:
+        df_pivot = df_resumo.T
+        
+        total_agendado = {}
+        for profissional in df_pivot.columns:
+            total_slots = df_pivot[profissional].sum()
+            livres = df_pivot.loc['Livre', profissional] if 'Livre' in df_pivot.index else 0
+            bloqueados = df_pivot.loc['Bloqueado', profissional] if 'Bloqueado' in df_pivot.index else 0
+            total_agendado[profissional] = int(total_slots - livres - bloqueados)
+        
+        df_pivot.loc['Total Agendado'] = pd.Series(total_agendado)
+        
+        # Em vez de gerar HTML, preparamos os dados para o Jinja2
+        view_model['table_headers'] = df_pivot.columns.tolist()
+        view_model['table_index'] = df_pivot.index.tolist()
+        view_model['table_body'] = df_pivot.values.tolist()
+
+    return view_model
+
+
+# --- Contagens numéricas (tabela agendas_daily_metrics) e análise por período ---
+COUNT_COLUMNS = ["total", "occupied", "confirmed", "attended", "no_show"]
+RANGE_GRANULARITIES = {"day": "D", "week": "W-SUN", "month": "M"}
+
+def professional_counts(resumo_geral: dict) -> dict:
+    """
+    Reduz o 'resumo_geral' de um dia a contagens numéricas por profissional:
+    {profissional: {"total", "occupied", "confirmed", "attended", "no_show"}}.
+    É o que fica materializado em agendas_daily_metrics.
+    """
+    if not resumo_geral:
+        return {}
+    df_resumo = pd.DataFrame.from_dict(resumo_geral, orient='index').fillna(0).astype(int)
+    masks = classify_status_columns(df_resumo.columns)
+    values = df_resumo.to_numpy(dtype=np.int64) if df_resumo.size else np.zeros((len(df_resumo.index), 0), dtype=np.int64)
+
+    totals = {
+        "total": values.sum(axis=1),
+        "occupied": values[:, masks["occupied"]].sum(axis=1),
+        "confirmed": values[:, masks["confirmed"]].sum(axis=1),
+        "attended": values[:, masks["attended"]].sum(axis=1),
+        "no_show": values[:, masks["no_show"]].sum(axis=1),
+    }
+    return {prof: {col: int(totals[col][i]) for col in COUNT_COLUMNS}
+            for i, prof in enumerate(df_resumo.index)}
+
+def counts_rates(counts: dict) -> dict:
+    """Taxas (em %, 2 casas) a partir de um dict com as colunas de COUNT_COLUMNS."""
+    occupied = counts.get("occupied", 0)
+    def rate(num, den):
+        return round(num / den * 100, 2) if den > 0 else 0.0
     return {
-        "conversion_rate": f"{taxa:.2f}%",
-        "total_atendidos": int(total_atendidos)
-    }
\ No newline at end of file
+        "taxa_ocupacao": rate(occupied, counts.get("total", 0)),
+        "taxa_confirmacao": rate(counts.get("confirmed", 0), occupied),
+        "taxa_conversao": rate(counts.get("attended", 0), occupied),
+        "taxa_faltas": rate(counts.get("no_show", 0), occupied),
+    }
+
+def _range_totals(df: pd.DataFrame, by: list) -> list:
+    """Soma as contagens por grupo e calcula as taxas (em %, 2 casas)."""
+    grouped = df.groupby(by, sort=True)[COUNT_COLUMNS].sum()
+    grouped["taxa_ocupacao"] = _rate(grouped["occupied"], grouped["total"]).round(2)
+    grouped["taxa_confirmacao"] = _rate(grouped["confirmed"], grouped["occupied"]).round(2)
+    grouped["taxa_conversao"] = _rate(grouped["attended"], grouped["occupied"]).round(2)
+    grouped["taxa_faltas"] = _rate(grouped["no_show"], grouped["occupied"]).round(2)
+    records = grouped.reset_index().to_dict(orient="records")
+    for record in records:
+        for col in COUNT_COLUMNS:
+            record[col] = int(record[col])
+    return records
+
+def calculate_range_metrics(rows: list, granularity: str = "day") -> dict:
+    """
+    Tendências de ocupação, confirmação, conversão e faltas ao longo de um período.
+    'rows' são as linhas de agendas_daily_metrics (ver cache_manager.load_daily_metrics):
+    dicts com unit_id, target_date, professional_name e as colunas de COUNT_COLUMNS.
+    """
+    empty = {"periods": [], "by_unit": [], "by_unit_period": [], "by_professional": [], "overall": {}}
+    if not rows:
+        return empty
+
+    df = pd.DataFrame(rows, columns=["unit_id", "target_date", "professional_name"] + COUNT_COLUMNS)
+    df["unit_id"] = df["unit_id"].astype(str)
+    df = df.rename(columns={"professional_name": "profissional"})
+    df[COUNT_COLUMNS] = df[COUNT_COLUMNS].fillna(0).astype(np.int64)
+
+    freq = RANGE_GRANULARITIES.get(granularity, "D")
+    df["period"] = pd.to_datetime(df["target_date"]).dt.to_period(freq).dt.start_time.dt.strftime('%Y-%m-%d')
+
+    overall = _range_totals(df.assign(_all=0), ["_all"])[0]
+    overall.pop("_all", None)
+    return {
+        "periods": _range_totals(df, ["period"]),
+        "by_unit": _range_totals(df, ["unit_id"]),
+        "by_unit_period": _range_totals(df, ["unit_id", "period"]),
+        "by_professional": _range_totals(df, ["unit_id", "profissional"]),
+        "overall": overall,
+    }
@@ -0,0 +1,100 @@
+# single_flight.py
+# Garante que só UMA busca na API rode por vez para a mesma chave (ex.: unidade + dia).
+# - Dentro do processo: a primeira thread executa, as demais esperam e recebem o mesmo resultado.
+# - Entre workers do gunicorn: a thread que executa segura um lock de arquivo local; os outros
+#   processos esperam o lock e, antes de buscar de novo, conferem se o resultado já está no cache.
+
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows (desenvolvimento local): só o agrupamento dentro do processo
+    fcntl = None
+
+LOCK_DIR = os.environ.get("SINGLE_FLIGHT_LOCK_DIR", os.path.join(tempfile.gettempdir(), "agenda_multipla_locks"))
+LOCK_TIMEOUT = float(os.environ.get("SINGLE_FLIGHT_TIMEOUT", "120"))
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight: dict[str, _Call] = {}
+_inflight_lock = threading.Lock()
+
+
+def _acquire_file_lock(key: str, timeout: float):
+    """Tenta obter o lock de arquivo da chave por até 'timeout' segundos. Retorna o arquivo ou None."""
+    if fcntl is None:
+        return None
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    safe_key = "".join(c if c.isalnum() or c in "-_" else "_" for c in key)
+    lock_file = open(os.path.join(LOCK_DIR, f"{safe_key}.lock"), "w")
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                lock_file.close()
+                print(f"AVISO [SINGLE FLIGHT]: Timeout esperando o lock de '{key}'. Seguindo sem lock.")
+                return None
+            time.sleep(0.2)
+
+
+def _release_file_lock(lock_file):
+    if lock_file is None:
+        return
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+
+def run_single_flight(key: str, fn, recheck=None, timeout: float = LOCK_TIMEOUT):
+    """
+    Executa 'fn()' no máximo uma vez por vez para a 'key'.
+
+    Se outra thread do mesmo processo já está executando para a mesma chave, espera e
+    devolve o MESMO objeto de resultado (o chamador não deve alterá-lo). Entre processos,
+    depois de obter o lock, chama 'recheck()' (se informado): um resultado diferente de None
+    significa que outro worker acabou de fazer o trabalho, e 'fn' não é executada.
+    """
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+
+    if not leader:
+        print(f"DEBUG [SINGLE FLIGHT]: Aguardando busca em andamento para '{key}'.")
+        call.done.wait(timeout)
+        if call.error:
+            raise call.error
+        return call.result
+
+    lock_file = None
+    try:
+        lock_file = _acquire_file_lock(key, timeout)
+        result = recheck() if recheck else None
+        if result is None:
+            result = fn()
+        else:
+            print(f"DEBUG [SINGLE FLIGHT]: '{key}' já foi atualizado por outro worker. Reutilizando.")
+        call.result = result
+        return result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        _release_file_lock(lock_file)
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        call.done.set()
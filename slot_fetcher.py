@@ -0,0 +1,73 @@
+# slot_fetcher.py
+# Busca concorrente (com limite de requisições simultâneas) dos horários
+# de vários profissionais de uma mesma unidade.
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Máximo de requisições simultâneas à API por unidade (configurável via variável de ambiente)
+MAX_IN_FLIGHT_PER_UNIT = int(os.environ.get("AMEI_MAX_IN_FLIGHT_PER_UNIT", "8"))
+
+
+def fetch_slots_concurrently(profissionais: list, fetch_fn, max_in_flight: int | None = None, on_progress=None) -> list:
+    """
+    Executa 'fetch_fn(prof_id)' para cada profissional usando um pool de threads limitado.
+
+    Retorna uma lista de tuplas (prof, slots) NA MESMA ORDEM de 'profissionais',
+    para que o dicionário context["agendas"] continue montado na ordem original.
+    A latência de cada requisição é impressa no console para diagnóstico.
+    Se 'fetch_fn' levantar uma exceção, o resultado daquele profissional é uma lista vazia.
+    Se informado, 'on_progress(concluidos, total)' é chamado a cada profissional concluído.
+    """
+    if not profissionais:
+        return []
+
+    workers = max(1, min(max_in_flight or MAX_IN_FLIGHT_PER_UNIT, len(profissionais)))
+    progress_lock = threading.Lock()
+    progress = {"done": 0}
+
+    def _timed_fetch(prof):
+        start = time.perf_counter()
+        try:
+            slots = fetch_fn(prof.get('id'))
+        except Exception as e:
+            # Uma falha isolada não deve derrubar a busca dos outros profissionais
+            print(f"Erro [FETCH]: Falha ao buscar slots do profissional {prof.get('id')}: {e}")
+            slots = []
+        elapsed = time.perf_counter() - start
+        if on_progress:
+            with progress_lock:
+                progress["done"] += 1
+                on_progress(progress["done"], len(profissionais))
+        return slots, elapsed
+
+    total_start = time.perf_counter()
+    # executor.map preserva a ordem de entrada, independente da ordem de conclusão
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_timed_fetch, profissionais))
+    total_elapsed = time.perf_counter() - total_start
+
+    latencies = []
+    for prof, (slots, elapsed) in zip(profissionais, results):
+        latencies.append(elapsed)
+        print(f"DEBUG [FETCH]: Prof {prof.get('id')} -> {_count_slots(slots)} slots em {elapsed * 1000:.0f} ms")
+
+    print(
+        f"DEBUG [FETCH]: {len(profissionais)} profissionais em {total_elapsed:.2f}s "
+        f"({workers} em paralelo | mais lenta: {max(latencies):.2f}s | "
+        f"média: {sum(latencies) / len(latencies):.2f}s)"
+    )
+
+    # O resultado de 'fetch_fn' é devolvido sem alteração (pode ser None para sinalizar falha)
+    return [(prof, slots) for prof, (slots, _) in zip(profissionais, results)]
+
+
+def _count_slots(slots) -> str:
+    """Conta os slots de uma lista ou de um dict {dia: [slots]} (busca por período)."""
+    if slots is None:
+        return "0 (falha)"
+    if isinstance(slots, dict):
+        return str(sum(len(day_slots) for day_slots in slots.values()))
+    return str(len(slots))
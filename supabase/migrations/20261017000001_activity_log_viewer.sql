@@ -0,0 +1,61 @@
+-- Índices e tabela auxiliar para o visualizador do log de atividades.
+-- O custo da página passa a ser constante mesmo com milhões de registros:
+--   * paginação por cursor (timestamp, id) usa activity_log_timestamp_id_idx;
+--   * filtros por usuário/ação usam os índices compostos com timestamp;
+--   * a busca por trecho em 'details' (ILIKE '%...%') usa o índice trigram;
+--   * os menus de filtro leem a tabela pequena activity_log_filter_values,
+--     mantida por trigger, em vez de varrer o log inteiro.
+
+create extension if not exists pg_trgm;
+
+create index if not exists activity_log_timestamp_id_idx
+    on public.activity_log (timestamp desc, id desc);
+
+create index if not exists activity_log_username_timestamp_idx
+    on public.activity_log (username, timestamp desc);
+
+create index if not exists activity_log_action_timestamp_idx
+    on public.activity_log (action, timestamp desc);
+
+create index if not exists activity_log_details_trgm_idx
+    on public.activity_log using gin (details gin_trgm_ops);
+
+-- Valores distintos de usuário e ação para os menus de filtro
+create table if not exists public.activity_log_filter_values (
+    kind  text not null check (kind in ('username', 'action')),
+    value text not null,
+    primary key (kind, value)
+);
+
+create or replace function public.activity_log_track_filter_values()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.username is not null then
+        insert into public.activity_log_filter_values (kind, value)
+        values ('username', new.username)
+        on conflict do nothing;
+    end if;
+    if new.action is not null then
+        insert into public.activity_log_filter_values (kind, value)
+        values ('action', new.action)
+        on conflict do nothing;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists activity_log_track_filter_values on public.activity_log;
+create trigger activity_log_track_filter_values
+    after insert on public.activity_log
+    for each row execute function public.activity_log_track_filter_values();
+
+-- Carga inicial com o que já existe no log
+insert into public.activity_log_filter_values (kind, value)
+select distinct 'username', username from public.activity_log where username is not null
+on conflict do nothing;
+
+insert into public.activity_log_filter_values (kind, value)
+select distinct 'action', action from public.activity_log where action is not null
+on conflict do nothing;
@@ -0,0 +1,76 @@
+-- Gravação de usuário + unidades em UMA transação (chamada via RPC pelo user_manager).
+-- Em vez de apagar todas as relações e inserir de novo, compara as unidades atuais com as
+-- desejadas e aplica só as diferenças: o usuário nunca fica sem unidades no meio do caminho.
+--
+-- p_unidades: objeto {"<id da unidade>": "<nome>", ...} (mesmo formato de session['unidades'])
+
+create or replace function public.save_user_with_units(
+    p_username text,
+    p_role text,
+    p_password_hash text,
+    p_unidades jsonb
+)
+returns void
+language plpgsql
+as $$
+declare
+    v_unit_ids bigint[];
+begin
+    -- 1. Dados simples do usuário (campos nulos mantêm o valor atual)
+    insert into public.users (username, role, password_hash)
+    values (p_username, coalesce(p_role, 'user'), p_password_hash)
+    on conflict (username) do update
+        set role = coalesce(excluded.role, public.users.role),
+            password_hash = coalesce(excluded.password_hash, public.users.password_hash);
+
+    select coalesce(array_agg(key::bigint), '{}')
+      into v_unit_ids
+      from jsonb_each_text(coalesce(p_unidades, '{}'::jsonb));
+
+    -- 2. Garante que as unidades existem (e atualiza o nome)
+    insert into public.unidades (id, nome)
+    select key::bigint, value
+      from jsonb_each_text(coalesce(p_unidades, '{}'::jsonb))
+    on conflict (id) do update set nome = excluded.nome
+    where public.unidades.nome is distinct from excluded.nome;
+
+    -- 3. Remove só as relações que saíram
+    delete from public.user_unidades
+     where username = p_username
+       and not (unidade_id = any (v_unit_ids));
+
+    -- 4. Insere só as relações novas
+    insert into public.user_unidades (username, unidade_id)
+    select p_username, unit_id
+      from unnest(v_unit_ids) as unit_id
+     where not exists (
+         select 1 from public.user_unidades uu
+          where uu.username = p_username and uu.unidade_id = unit_id
+     );
+end;
+$$;
+
+-- Importação em lote: p_users é uma lista
+-- [{"username": ..., "role": ..., "password_hash": ..., "unidades": {"<id>": "<nome>"}}, ...]
+-- Tudo ou nada: se um usuário falhar, nenhum é gravado.
+create or replace function public.bulk_save_users(p_users jsonb)
+returns integer
+language plpgsql
+as $$
+declare
+    v_user jsonb;
+    v_count integer := 0;
+begin
+    for v_user in select * from jsonb_array_elements(coalesce(p_users, '[]'::jsonb))
+    loop
+        perform public.save_user_with_units(
+            v_user->>'username',
+            v_user->>'role',
+            v_user->>'password_hash',
+            v_user->'unidades'
+        );
+        v_count := v_count + 1;
+    end loop;
+    return v_count;
+end;
+$$;
@@ -0,0 +1,71 @@
+-- Métricas diárias materializadas: uma linha numérica por (unidade, dia, profissional),
+-- gravada pelo cache_manager junto com o cache do dia. Dashboards entre unidades e entre
+-- dias somam esta tabela (consulta indexada) em vez de abrir o JSON de cada resumo.
+--
+-- As regras de classificação são as de metrics.classify_status_columns:
+--   occupied  = status diferente de 'Livre' e 'Bloqueado'
+--   confirmed = ocupado e contém 'confirmado'
+--   attended  = contém 'atendido', 'atendimento concluído', 'finalizado' ou 'aguardando pós-consulta'
+--   no_show   = status igual a 'Não compareceu'
+
+create table if not exists public.agendas_daily_metrics (
+    unit_id           bigint  not null,
+    target_date       date    not null,
+    professional_name text    not null,
+    total             integer not null default 0,
+    occupied          integer not null default 0,
+    confirmed         integer not null default 0,
+    attended          integer not null default 0,
+    no_show           integer not null default 0,
+    primary key (unit_id, target_date, professional_name),
+    foreign key (unit_id, target_date)
+        references public.agendas_cache_summary (unit_id, target_date)
+        on delete cascade
+);
+
+-- Consultas por período de todas as unidades (dashboard / análise por período)
+create index if not exists agendas_daily_metrics_date_unit_idx
+    on public.agendas_daily_metrics (target_date, unit_id);
+
+-- Totais por unidade em um período: uma consulta agregada, sem JSON
+create or replace function public.daily_metrics_by_unit(p_unit_ids bigint[], p_start date, p_end date)
+returns table (
+    unit_id bigint,
+    days integer,
+    total bigint,
+    occupied bigint,
+    confirmed bigint,
+    attended bigint,
+    no_show bigint
+)
+language sql
+stable
+as $$
+    select m.unit_id,
+           count(distinct m.target_date)::integer,
+           sum(m.total), sum(m.occupied), sum(m.confirmed), sum(m.attended), sum(m.no_show)
+      from public.agendas_daily_metrics m
+     where m.unit_id = any (p_unit_ids)
+       and m.target_date between p_start and p_end
+     group by m.unit_id;
+$$;
+
+-- Carga inicial a partir dos resumos que já estão no cache
+insert into public.agendas_daily_metrics
+    (unit_id, target_date, professional_name, total, occupied, confirmed, attended, no_show)
+select s.unit_id,
+       s.target_date,
+       prof.key,
+       coalesce(sum(st.value::integer), 0),
+       coalesce(sum(st.value::integer) filter (where st.key not in ('Livre', 'Bloqueado')), 0),
+       coalesce(sum(st.value::integer) filter (where st.key not in ('Livre', 'Bloqueado')
+                                                  and lower(st.key) like '%confirmado%'), 0),
+       coalesce(sum(st.value::integer) filter (where lower(st.key) like any (array[
+                                                  '%atendido%', '%atendimento concluído%',
+                                                  '%finalizado%', '%aguardando pós-consulta%'])), 0),
+       coalesce(sum(st.value::integer) filter (where st.key = 'Não compareceu'), 0)
+  from public.agendas_cache_summary s
+  cross join lateral jsonb_each(coalesce(s.summary_data->'resumo_geral', '{}'::jsonb)) as prof
+  cross join lateral jsonb_each_text(prof.value) as st
+ group by s.unit_id, s.target_date, prof.key
+on conflict (unit_id, target_date, professional_name) do nothing;
@@ -0,0 +1,23 @@
+-- Estado dos jobs de atualização de cache (app/services/cache_jobs.py).
+-- O job roda no worker do gunicorn que o criou, mas o navegador acompanha o progresso
+-- por GET /api/cache_jobs/<id>, que pode cair em qualquer worker (ou dyno): o estado
+-- fica aqui para todos enxergarem. Jobs concluídos são apagados depois de CACHE_JOB_TTL.
+
+create table if not exists public.cache_jobs (
+    id           text primary key,
+    unit_id      text        not null,
+    unit_name    text,
+    target_date  date        not null,
+    status       text        not null,
+    progress     jsonb       not null default '{"done": 0, "total": 0}'::jsonb,
+    message      text        not null default '',
+    requested_by text,
+    created_at   timestamptz not null,
+    started_at   timestamptz,
+    finished_at  timestamptz
+);
+
+-- Limpeza dos jobs concluídos
+create index if not exists cache_jobs_finished_at_idx
+    on public.cache_jobs (finished_at)
+    where finished_at is not null;
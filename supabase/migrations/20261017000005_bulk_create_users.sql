@@ -0,0 +1,49 @@
+-- Importação em lote SÓ cria usuários: quem já existe é pulado, nunca atualizado.
+-- A verificação e a gravação acontecem no mesmo insert (on conflict do nothing), então um
+-- usuário criado por outra pessoa durante a importação não tem senha nem perfil sobrescritos.
+--
+-- p_users: [{"username": ..., "role": ..., "password_hash": ..., "unidades": {"<id>": "<nome>"}}, ...]
+-- Retorna {"created": [usernames], "skipped": [usernames que já existiam]}.
+-- Tudo ou nada: se um usuário falhar, nenhum é gravado.
+
+drop function if exists public.bulk_save_users(jsonb);
+
+create or replace function public.bulk_create_users(p_users jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_user jsonb;
+    v_username text;
+    v_created text[] := '{}';
+    v_skipped text[] := '{}';
+begin
+    for v_user in select * from jsonb_array_elements(coalesce(p_users, '[]'::jsonb))
+    loop
+        v_username := null;
+        insert into public.users (username, role, password_hash)
+        values (v_user->>'username', coalesce(v_user->>'role', 'user'), v_user->>'password_hash')
+        on conflict (username) do nothing
+        returning username into v_username;
+
+        if v_username is null then
+            v_skipped := v_skipped || (v_user->>'username');
+            continue;
+        end if;
+
+        insert into public.unidades (id, nome)
+        select key::bigint, value
+          from jsonb_each_text(coalesce(v_user->'unidades', '{}'::jsonb))
+        on conflict (id) do update set nome = excluded.nome
+        where public.unidades.nome is distinct from excluded.nome;
+
+        insert into public.user_unidades (username, unidade_id)
+        select v_username, key::bigint
+          from jsonb_each_text(coalesce(v_user->'unidades', '{}'::jsonb));
+
+        v_created := v_created || v_username;
+    end loop;
+
+    return jsonb_build_object('created', to_jsonb(v_created), 'skipped', to_jsonb(v_skipped));
+end;
+$$;
@@ -4,23 +4,20 @@ import os
 from datetime import date, timedelta, datetime
 from zoneinfo import ZoneInfo
 import json
+import time
 import requests
-import pandas as pd
 
 # Adiciona o caminho do diretório atual ao sys.path para que imports funcionem
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from cache_manager import save_agendas_to_cache_v2
-from cache_manager import delete_day_from_cache_v2  # Importa a função para deletar o cache de um dia
+from cache_manager import save_agendas_delta_v2, load_cache_version, load_agendas_from_cache_v2
+from cache_manager import save_period_to_cache_v2
 # Importando as funções de métrica com os nomes corretos
-from metrics import (
-    calculate_summary_metrics,
-    calculate_confirmation_ranking,
-    calculate_occupation_ranking,
-    calculate_conversion_ranking,
-    calculate_global_conversion_rate
-)
+from metrics import build_view_model
 from login_auth import get_auth_new
+import amei_client
+from slot_fetcher import fetch_slots_concurrently
+from single_flight import run_single_flight
 
 # --- Funções de API ---
 # Estas funções agora recebem 'headers' e 'clinic_id' para serem mais flexíveis
@@ -29,7 +26,7 @@ def get_all_professionals_script(headers):
     """Busca todos os profissionais da API."""
     try:
         url = 'https://amei.amorsaude.com.br/api/v1/profissionais/by-unidade'
-        response = requests.get(url, headers=headers)
+        response = amei_client.get(url, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
@@ -49,7 +46,7 @@ def get_slots_for_professional_script(professional_id, selected_date, clinic_id,
     }
     try:
         url = 'https://amei.amorsaude.com.br/api/v1/slots/list-slots-by-professional'
-        response = requests.get(url, headers=headers, params=params)
+        response = amei_client.get(url, headers=headers, params=params)
         response.raise_for_status()
         data = response.json()
         if data and isinstance(data, list) and len(data) > 0:
@@ -59,18 +56,72 @@ def get_slots_for_professional_script(professional_id, selected_date, clinic_id,
         print(f"Erro [update_script]: Erro ao buscar slots para prof {professional_id} na data {selected_date}: {e}")
         return []
 
-def process_and_cache_day(target_date: date, clinic_id: int):
+def get_slots_range_for_professional_script(professional_id, start_date, end_date, clinic_id, headers):
     """
-    Processa os dados de agenda para um dia e unidade específicos e os salva no cache.
-    Esta função agora é o "motor" que busca e calcula tudo.
+    Busca os horários de um profissional para TODO o período [start_date, end_date] em uma única chamada.
+    Retorna um dict {date: [slots]} ou None se a resposta não puder ser separada por dia
+    (nesse caso o chamador deve voltar para a busca dia a dia).
     """
-    print(f"--- [CACHE SCRIPT] Iniciando para data: {target_date.strftime('%Y-%m-%d')} | Unidade: {clinic_id} ---")
+    params = {
+        'idClinic': clinic_id,
+        'idSpecialty': 'null',
+        'idProfessional': professional_id,
+        'initialDate': start_date.strftime('%Y%m%d'),
+        'finalDate': end_date.strftime('%Y%m%d'),
+        'initialHour': '00:00',
+        'endHour': '23:59'
+    }
+    try:
+        url = 'https://amei.amorsaude.com.br/api/v1/slots/list-slots-by-professional'
+        response = amei_client.get(url, headers=headers, params=params)
+        response.raise_for_status()
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Erro [update_script]: Erro ao buscar slots para prof {professional_id} no período {start_date} a {end_date}: {e}")
+        return None
 
-    # --- Configuração de Autenticação ---
+    slots_by_day = {}
+    if not data or not isinstance(data, list):
+        return slots_by_day
+
+    try:
+        for day_entry in data:
+            if start_date == end_date and len(data) == 1:
+                # Mesmo formato da busca de um dia só (get_slots_for_professional_script)
+                day = start_date
+            else:
+                day = _parse_day_key(day_entry)
+                if not start_date <= day <= end_date:
+                    raise ValueError(f"dia {day} fora do período pedido")
+            slots_by_day.setdefault(day, []).extend(day_entry.get('hours', []))
+    except ValueError as e:
+        print(f"ERRO [update_script]: Resposta do período inválida para o prof {professional_id}: {e}. "
+              f"Usando busca dia a dia.")
+        return None
+    return slots_by_day
+
+# Campo com o dia de cada item da resposta de list-slots-by-professional, em 'YYYY-MM-DD'
+# (pode vir com horário depois, ex.: '2024-05-10T00:00:00').
+# NÃO CONFIRMADO: o nome do campo foi presumido, não verificado contra uma resposta real de
+# vários dias. Se estiver errado, a busca por período nunca é usada (ver o AVISO em
+# update_period_cache) e o script volta a fazer uma chamada por profissional por dia.
+SLOTS_DAY_FIELD = 'date'
+
+def _parse_day_key(day_entry):
+    """Data de um item da resposta de list-slots-by-professional. Levanta ValueError se não houver."""
+    if not isinstance(day_entry, dict) or not day_entry.get(SLOTS_DAY_FIELD):
+        keys = sorted(day_entry.keys()) if isinstance(day_entry, dict) else type(day_entry).__name__
+        raise ValueError(f"campo '{SLOTS_DAY_FIELD}' ausente (recebido: {keys})")
+    return date.fromisoformat(str(day_entry[SLOTS_DAY_FIELD])[:10])
+
+# --- Montagem do contexto ---
+
+def build_headers(clinic_id):
+    """Obtém o token da unidade e monta os headers das chamadas à API."""
     auth = get_auth_new(clinic_id)
     if not auth:
         print(f"ERRO CRÍTICO [CACHE SCRIPT]: Falha ao obter token para unidade {clinic_id}. Abortando.")
-        return
+        return None
 
     try:
         with open('credentials.json', 'r') as f:
@@ -80,27 +131,16 @@ def process_and_cache_day(target_date: date, clinic_id: int):
         cookie_value = os.environ.get("COOKIE_VALUE", "")
         print("DEBUG [CACHE SCRIPT]: Cookie carregado de variável de ambiente")
 
-    HEADERS = {'Authorization': f"Bearer {auth}", 'Cookie': cookie_value}
+    return {'Authorization': f"Bearer {auth}", 'Cookie': cookie_value}
 
-    # --- Coleta de Dados da API ---
+def _build_day_context(slots_por_profissional):
+    """Monta o 'context' de um dia (agendas, resumo e métricas) a partir de [(prof, slots), ...]."""
     context = {"agendas": {}, "resumo_geral": {}}
-    all_profissionais = get_all_professionals_script(HEADERS)
-    
-    if not all_profissionais:
-        print("AVISO [CACHE SCRIPT]: Nenhum profissional retornado pela API.")
-        return
-    
-    print(f"DEBUG [CACHE SCRIPT]: Encontrados {len(all_profissionais)} profissionais.")
 
-    for prof in all_profissionais:
+    for prof, slots in slots_por_profissional:
         prof_id = prof.get('id')
         prof_nome = prof.get('nome', f'Profissional ID {prof_id}')
         
-        slots = get_slots_for_professional_script(prof_id, target_date, clinic_id, HEADERS)
-        
-        # *** CORREÇÃO AQUI: REMOVA A CONDIÇÃO QUE FILTRA PROFISSIONAIS ***
-        # if any(slot.get('status') not in ["Livre", "Bloqueado"] for slot in slots):
-            
         # *** SEMPRE inclui o profissional, mesmo que tenha apenas horários livres ***
         context["agendas"][prof_nome] = {
             "id": prof_id,
@@ -127,37 +167,154 @@ def process_and_cache_day(target_date: date, clinic_id: int):
         context["resumo_geral"][prof_nome] = contagem_status
 
     # --- Cálculo de Métricas ---
+    # Salva o view model completo (métricas, rankings e tabela) junto com o cache
+    context.update(build_view_model(context["resumo_geral"]))
     if context["resumo_geral"]:
-        df_resumo = pd.DataFrame.from_dict(context["resumo_geral"], orient='index').fillna(0).astype(int)
-        
-        context["summary_metrics"] = calculate_summary_metrics(context["resumo_geral"], df_resumo.copy())
-        context["conversion_data_for_selected_day"] = calculate_global_conversion_rate(df_resumo.copy())
-        context["profissionais_stats_confirmacao"] = calculate_confirmation_ranking(df_resumo.copy())
-        context["profissionais_stats_ocupacao"] = calculate_occupation_ranking(df_resumo.copy())
-        context["profissionais_stats_conversao"] = calculate_conversion_ranking(df_resumo.copy())
-
         # DEBUG: Imprime as métricas calculadas antes de salvar
         total_atendidos_debug = context.get("conversion_data_for_selected_day", {}).get("total_atendidos", "N/A")
         print(f"DEBUG [CACHE SCRIPT]: Métricas calculadas. Total de atendidos: {total_atendidos_debug}")
 
-    
     now = datetime.now(ZoneInfo("America/Sao_Paulo"))
     context['last_updated_iso'] = now.isoformat()
     context['last_updated_formatted'] = now.strftime('%H:%M - %d/%m/%Y')
+    return context
+
+def process_and_cache_day(target_date: date, clinic_id: int, on_progress=None):
+    """
+    Processa os dados de agenda para um dia e unidade específicos e os salva no cache.
+    Esta função agora é o "motor" que busca e calcula tudo.
+    Retorna True se o dia foi processado, False se a autenticação, a busca ou a gravação falharam.
+    'on_progress(concluidos, total)' é chamado a cada profissional buscado (usado pelos jobs de cache).
+    """
+    return refresh_day_cache(target_date, clinic_id, on_progress) is not None
+
+def _updated_since(last_updated_iso, since_ts: float) -> bool:
+    """True se 'last_updated_iso' é posterior ao instante 'since_ts' (epoch)."""
+    try:
+        last_updated = datetime.fromisoformat(last_updated_iso)
+    except (ValueError, TypeError):
+        return False
+    if last_updated.tzinfo is None:
+        # Entradas antigas foram gravadas sem fuso; assume horário de São Paulo
+        last_updated = last_updated.replace(tzinfo=ZoneInfo("America/Sao_Paulo"))
+    return last_updated.timestamp() >= since_ts
+
+def refresh_day_cache(target_date: date, clinic_id: int, on_progress=None,
+                      requested_at: float | None = None) -> dict | None:
+    """
+    Igual a process_and_cache_day, mas retorna o 'context' salvo (ou None em caso de falha),
+    para quem ainda usa os dados do dia depois da gravação (ex.: pré-carga de detalhes dos jobs).
+    Só uma atualização por (unidade, dia) roda por vez, mesmo entre workers (ver single_flight.py).
+    Se, ao obter o lock, o cache do dia já foi gravado depois de 'requested_at' (epoch; padrão:
+    agora) por outro worker, a busca na API é pulada e o context gravado é retornado.
+    """
+    requested_at = time.time() if requested_at is None else requested_at
+
+    def _recheck():
+        version = load_cache_version(clinic_id, target_date)
+        if not version or not _updated_since(version.get('last_updated_iso'), requested_at):
+            return None
+        return load_agendas_from_cache_v2(target_date, clinic_id,
+                                          expected_version=version['last_updated_iso'])
+
+    return run_single_flight(
+        f"{clinic_id}:{target_date.isoformat()}",
+        lambda: _process_and_cache_day(target_date, clinic_id, on_progress),
+        recheck=_recheck
+    )
+
+def _process_and_cache_day(target_date: date, clinic_id: int, on_progress=None):
+    print(f"--- [CACHE SCRIPT] Iniciando para data: {target_date.strftime('%Y-%m-%d')} | Unidade: {clinic_id} ---")
+
+    # --- Configuração de Autenticação ---
+    HEADERS = build_headers(clinic_id)
+    if not HEADERS:
+        return None
+
+    # --- Coleta de Dados da API ---
+    all_profissionais = get_all_professionals_script(HEADERS)
+    
+    if not all_profissionais:
+        print("AVISO [CACHE SCRIPT]: Nenhum profissional retornado pela API.")
+        return None
+    
+    print(f"DEBUG [CACHE SCRIPT]: Encontrados {len(all_profissionais)} profissionais.")
+
+    # Busca os horários de todos os profissionais em paralelo (ordem preservada)
+    slots_por_profissional = fetch_slots_concurrently(
+        all_profissionais,
+        lambda prof_id: get_slots_for_professional_script(prof_id, target_date, clinic_id, HEADERS),
+        on_progress=on_progress
+    )
+
+    context = _build_day_context(slots_por_profissional)
 
-    # Salva o dicionário 'context' completo no cache
-    delete_day_from_cache_v2(target_date, clinic_id)   # Limpa o cache antigo
-    save_agendas_to_cache_v2(context, target_date, clinic_id)
+    # Salva no cache só o que mudou (sem apagar o dia antes)
+    if not save_agendas_delta_v2(context, target_date, clinic_id):
+        return None
     print(f"--- [CACHE SCRIPT] Cache para {target_date.strftime('%Y-%m-%d')} atualizado com sucesso. ---")
+    return context
 
 def update_period_cache(start_date: date, end_date: date, clinic_id: int):
-    """Atualiza o cache para um período de datas e uma unidade específica."""
+    """
+    Atualiza o cache para um período de datas e uma unidade específica.
+    Faz UM login, UMA busca de profissionais e UMA chamada de slots por profissional
+    para o período inteiro; os dias são separados localmente e gravados em lote.
+    """
     print(f"Iniciando atualização de cache para o período de {start_date.strftime('%Y-%m-%d')} a {end_date.strftime('%Y-%m-%d')} na unidade {clinic_id}")
-    
+
+    HEADERS = build_headers(clinic_id)
+    if not HEADERS:
+        return
+
+    all_profissionais = get_all_professionals_script(HEADERS)
+    if not all_profissionais:
+        print("AVISO [CACHE SCRIPT]: Nenhum profissional retornado pela API.")
+        return
+
+    print(f"DEBUG [CACHE SCRIPT]: Encontrados {len(all_profissionais)} profissionais.")
+
+    # Uma chamada por profissional cobrindo todo o período (em paralelo, ordem preservada)
+    ranges_por_profissional = fetch_slots_concurrently(
+        all_profissionais,
+        lambda prof_id: get_slots_range_for_professional_script(prof_id, start_date, end_date, clinic_id, HEADERS)
+    )
+
+    days = []
     current_date = start_date
     while current_date <= end_date:
-        process_and_cache_day(current_date, clinic_id)
+        days.append(current_date)
         current_date += timedelta(days=1)
+
+    # Profissionais cuja resposta do período não pôde ser separada (ou falhou): busca dia a dia
+    fallback_profs = [prof for prof, slots_by_day in ranges_por_profissional if not isinstance(slots_by_day, dict)]
+    if fallback_profs:
+        print(f"AVISO [CACHE SCRIPT]: Busca por período indisponível para {len(fallback_profs)} de "
+              f"{len(ranges_por_profissional)} profissionais (unidade {clinic_id}). Eles serão buscados dia a dia: "
+              f"{len(fallback_profs) * len(days)} chamadas em vez de {len(fallback_profs)}, sem a economia da "
+              f"busca por período. Se for em todos, confira SLOTS_DAY_FIELD contra a resposta real da API.")
+
+    contexts_by_date = {}
+    for day in days:
+        fallback_slots = {}
+        if fallback_profs:
+            # Mesma busca concorrente da atualização de um dia, só para esses profissionais
+            fallback_slots = {
+                id(prof): slots for prof, slots in fetch_slots_concurrently(
+                    fallback_profs,
+                    lambda prof_id, day=day: get_slots_for_professional_script(prof_id, day, clinic_id, HEADERS)
+                )
+            }
+        slots_por_profissional = []
+        for prof, slots_by_day in ranges_por_profissional:
+            if isinstance(slots_by_day, dict):
+                slots = slots_by_day.get(day, [])
+            else:
+                slots = fallback_slots[id(prof)]
+            slots_por_profissional.append((prof, slots))
+        contexts_by_date[day] = _build_day_context(slots_por_profissional)
+
+    save_period_to_cache_v2(contexts_by_date, clinic_id)
     
     print("Atualização de cache finalizada para o período.")
 
@@ -175,4 +332,4 @@ if __name__ == '__main__':
 
     update_period_cache(start_date_update, end_date_update, DEFAULT_CLINIC_ID)
     
-    print("Execução do script de atualização de cache em background finalizada.")
\ No newline at end of file
+    print("Execução do script de atualização de cache em background finalizada.")